@@ -0,0 +1,38 @@
+import json
+import os
+
+from character import DruidCharacter
+from items import ALL_ON_USE_ITEMS
+from main import build_axes, prepare_gear
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_config.json")
+# test_config.json has no on use item, these are added for the on use benchmarks
+ON_USE_ITEMS = ["direbrew_hops", "essence_of_the_martyr"]
+
+
+class Fixture(object):
+    """first combination of test_config.json, with the objects sim_loop would build for it"""
+    def __init__(self, config_path=CONFIG_PATH):
+        with open(config_path, "r", encoding="utf-8") as file:
+            self.config = json.load(file)
+        all_buffs, all_talents, all_assignments = build_axes(self.config)
+        self.charac_info = self.config["characters"][0]
+        self.buffs = all_buffs[0]
+        self.talents = all_talents[0]
+        self.assignments = all_assignments[0]
+        self.gems_policy = self.config["gems_policy"][0]
+        self.gear = prepare_gear(self.config["characters"], self.config["gems_policy"], [(0, 0)])[(0, 0)]
+        self.fight_duration = self.config["fight_duration"]
+        self.on_use_items = [ALL_ON_USE_ITEMS[name] for name in ON_USE_ITEMS]
+
+    def character(self):
+        """a new character, without any memoized stat"""
+        stats_buffs, spell_buffs = self.buffs
+        return DruidCharacter(
+            stats=self.charac_info["stats"],
+            talents=self.talents,
+            stats_buffs=stats_buffs,
+            spell_buffs=spell_buffs,
+            gear=self.gear,
+            level=self.charac_info["level"]
+        )
@@ -0,0 +1,95 @@
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+
+class Benchmark(object):
+    """An operation to time: fn(state) is timed, state = setup() is built before each call and is not timed. A
+    regression is reported when ops/sec drops by more than `threshold` (relative) below the baseline."""
+    def __init__(self, name, fn, setup=None, threshold=0.25):
+        self.name = name
+        self.fn = fn
+        self.setup = setup
+        self.threshold = threshold
+
+    def _call(self):
+        state = self.setup() if self.setup is not None else None
+        start = time.perf_counter()
+        self.fn(state)
+        return time.perf_counter() - start
+
+    def _allocations(self):
+        """(peak, net) bytes allocated by one call"""
+        state = self.setup() if self.setup is not None else None
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            self.fn(state)
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peak - before, after - before
+
+    def run(self, min_time=0.5, min_ops=5, warmup=1):
+        for _ in range(warmup):
+            self._call()
+        durations, total = list(), 0
+        while total < min_time or len(durations) < min_ops:
+            durations.append(self._call())
+            total += durations[-1]
+        peak, net = self._allocations()
+        return {
+            "ops": len(durations),
+            "ops_per_sec": len(durations) / total,
+            "median_s": sorted(durations)[len(durations) // 2],
+            "min_s": min(durations),
+            "alloc_peak_bytes": peak,
+            "alloc_net_bytes": net,
+            "threshold": self.threshold
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(benchmarks, min_time=0.5, min_ops=5, report=print):
+    results = dict()
+    for benchmark in benchmarks:
+        result = benchmark.run(min_time=min_time, min_ops=min_ops)
+        results[benchmark.name] = result
+        report("{: <40} {:12.1f} ops/s {:10.3f} ms/op {:10.1f} KiB peak".format(
+            benchmark.name, result["ops_per_sec"], 1000 * result["median_s"], result["alloc_peak_bytes"] / 1024))
+    return {
+        "meta": {"revision": git_revision(), "python": platform.python_version(), "machine": platform.machine(),
+                 "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results
+    }
+
+
+def compare(results, baseline):
+    """benchmarks slower than the baseline by more than their threshold: (name, ops/sec, baseline ops/sec)"""
+    regressions = list()
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]["ops_per_sec"]
+        if result["ops_per_sec"] < base * (1 - result["threshold"]):
+            regressions.append((name, result["ops_per_sec"], base))
+    return regressions
+
+
+def save(results, path):
+    with open(path, "w", encoding="utf8") as file:
+        json.dump(results, file, indent=2)
+
+
+def load(path):
+    with open(path, "r", encoding="utf8") as file:
+        return json.load(file)
@@ -0,0 +1,84 @@
+"""Simulator hot path benchmarks, run from the repository root:
+
+    python -m benchmarks.run -o results.json [--baseline previous.json]
+
+Exits with 1 if a benchmark is slower than the baseline by more than its threshold."""
+import contextlib
+import fnmatch
+import io
+import sys
+from argparse import ArgumentParser
+
+from benchmarks.fixtures import Fixture
+from benchmarks.harness import Benchmark, run_suite, compare, save, load
+from main import sim_loop
+from rotation import Rotation, make_on_use_timelines
+from spell import HEALING_TOUCH, REJUVENATION, REGROWTH, LIFEBLOOM, TRANQUILITY, heal_matrices
+from statistics import Stats
+
+
+def make_suite(fixture):
+    suite = list()
+
+    def get_all_stats(character):
+        for stat in Stats.all_stats():
+            character.get_stat(stat)
+    suite.append(Benchmark("character.get_stat[all]", get_all_stats, setup=fixture.character))
+
+    character = fixture.character()
+    for spells in [HEALING_TOUCH, REJUVENATION, REGROWTH, LIFEBLOOM, TRANQUILITY]:
+        spell = spells[-1]
+        suite.append(Benchmark("spell.get_healing[{}]".format(spell.name), lambda _, s=spell: s.get_healing(character)))
+        suite.append(Benchmark("spell.heal_matrices[{}]".format(spell.name),
+                               lambda _, s=spells: heal_matrices(s, character, range(0, 3001, 100))))
+
+    for duration in [120, 600]:
+        suite.append(Benchmark(
+            "rotation.optimal_rotation[{}s]".format(duration),
+            lambda _, d=duration: Rotation(fixture.assignments).optimal_rotation(character, d, reuse=False),
+            threshold=0.3))
+
+    rotation = Rotation(fixture.assignments)
+    rotation.optimal_rotation(character, fixture.fight_duration, reuse=False)
+    on_use = make_on_use_timelines(fixture.fight_duration, fixture.on_use_items, rotation.cast_timeline)
+    suite.append(Benchmark("rotation.stats", lambda _: rotation.stats(character, 0, fixture.fight_duration)))
+    suite.append(Benchmark("rotation.stats[on_use]",
+                           lambda _: rotation.stats(character, 0, fixture.fight_duration, on_use=on_use)))
+    suite.append(Benchmark("make_on_use_timelines",
+                           lambda _: make_on_use_timelines(fixture.fight_duration, fixture.on_use_items,
+                                                           rotation.cast_timeline)))
+
+    def full_combination(_):
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim_loop(0, 1, fixture.charac_info, fixture.buffs, fixture.talents, fixture.assignments,
+                     fixture.gems_policy, fixture.gear, fixture.fight_duration, False, None)
+    # the schedule cache would turn every call after the first one into a cache hit
+    suite.append(Benchmark("main.sim_loop", full_combination, setup=Rotation.clear_schedules, threshold=0.3))
+    return suite
+
+
+def main(argv):
+    parser = ArgumentParser()
+    parser.add_argument("-o", "--output", dest="output", default=None)
+    parser.add_argument("-b", "--baseline", dest="baseline", default=None)
+    parser.add_argument("-k", "--filter", dest="filter", default="*", help="fnmatch pattern on benchmark names")
+    parser.add_argument("--min-time", dest="min_time", default=0.5, type=float)
+    parser.add_argument("--min-ops", dest="min_ops", default=5, type=int)
+    args, _ = parser.parse_known_args(argv)
+
+    suite = [b for b in make_suite(Fixture()) if fnmatch.fnmatchcase(b.name, args.filter)]
+    results = run_suite(suite, min_time=args.min_time, min_ops=args.min_ops)
+    if args.output is not None:
+        save(results, args.output)
+
+    if args.baseline is not None:
+        regressions = compare(results, load(args.baseline))
+        for name, ops, base in regressions:
+            print("REGRESSION {}: {:.1f} ops/s vs {:.1f} ops/s in baseline ({:+.0%})".format(
+                name, ops, base, ops / base - 1))
+        return 1 if len(regressions) > 0 else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
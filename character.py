@@ -1,14 +1,27 @@
-import math
 from abc import abstractmethod, ABC
 
+import numpy as np
+
 from buffs import ALL_STATS_BUFFS, ALL_SPELL_BUFFS
-from items import Gear, ALL_ITEMS_GEAR
+from items import Gear
+from spell import SpellTable
 from statsmodifiers import StatsModifierArray, StatsModifier
 from statistics import Stats, linear, BASE_MANA_LOOKUP, linear_params, RATING_FORMULA
 from talents import Talents, DruidTalents
+from util import sqrt, maximum, minimum
 
 
 class Character(object):
+    """A character does not change once built (its stats, talents, buffs and gear are set by its constructor): stat
+    values, stat formulas, spell tables and buffed characters are memoized for its whole life. A different setup is
+    a new character."""
+    def __init__(self):
+        self._stat_cache = dict()
+        self._stats_plan = None
+        self._buffed_cache = dict()
+        self._spell_tables = dict()
+        self._formula_cache = dict()
+
     @property
     @abstractmethod
     def level(self):
@@ -58,31 +71,162 @@ class Character(object):
         """
         pass
 
+    @staticmethod
+    def _stat_key(stat, context):
+        return stat, tuple(sorted(context.items())) if context else ()
+
     def get_stat(self, stat, **context):
-        """get buffed and talented stat value"""
-        base = self.get_base_stat(stat)
-        return self.stats_effects.apply(stat, base, self, **context)
+        """get buffed and talented stat value (memoized per stat and context)"""
+        key = self._stat_key(stat, context)
+        if key not in self._stat_cache:
+            base = self.get_base_stat(stat)
+            self._stat_cache[key] = self.stats_effects.apply(stat, base, self, **context)
+        return self._stat_cache[key]
+
+    @property
+    def stats_plan(self):
+        """compiled evaluation plan of the stat sheet"""
+        if self._stats_plan is None:
+            self._stats_plan = StatsPlan(self)
+        return self._stats_plan
+
+    def buffed(self, stats_modifiers=(), spell_modifiers=()):
+        """get the character with additional stats and spell modifiers. Buffed characters are shared (with their stat
+        cache) between calls with the same modifiers. Modifiers are keyed by identity as their names are not unique."""
+        key = (tuple(stats_modifiers), tuple(spell_modifiers))
+        if len(key[0]) == 0 and len(key[1]) == 0:
+            return self
+        if key not in self._buffed_cache:
+            self._buffed_cache[key] = BuffedCharacter(
+                self,
+                stats_buffs=StatsModifierArray(key[0]) if len(key[0]) > 0 else None,
+                spell_buffs=StatsModifierArray(key[1]) if len(key[1]) > 0 else None)
+        return self._buffed_cache[key]
+
+    def spell_table(self, spell):
+        """values of the spell derived for this character, computed on first use (see SpellTable)"""
+        if spell not in self._spell_tables:
+            self._spell_tables[spell] = SpellTable(spell, self)
+        return self._spell_tables[spell]
+
+    def stat_sheet(self, **context):
+        """get all buffed and talented stats in a single pass, values are memoized as with get_stat"""
+        sheet = self.stats_plan.evaluate(**context)
+        for stat, value in sheet.items():
+            self._stat_cache[self._stat_key(stat, context)] = value
+        return sheet
 
     def get_base_stat(self, stat):
         """get base stat value"""
         return self.base_stats.get(stat, 0)
 
     def get_formula(self, stat, **context):
-        """get full formula for a stat"""
-        base = "#Stats.{stat}#".format(stat=Stats.base(stat))
-        return self.stats_effects.formula(stat, base, **context)
+        """get full formula for a stat (memoized per stat and context)"""
+        key = self._stat_key(stat, context)
+        if key not in self._formula_cache:
+            base = "#Stats.{stat}#".format(stat=Stats.base(stat))
+            self._formula_cache[key] = self.stats_effects.formula(stat, base, **context)
+        return self._formula_cache[key]
 
     def get_base_formula(self, stat):
         return str(self.get_base_stat(stat))
 
 
+class _StatsProxy(object):
+    """Stands for a character when applying modifiers, context-free stat lookups are answered by `lookup`"""
+    def __init__(self, character, lookup):
+        self._character = character
+        self._lookup = lookup
+
+    def get_stat(self, stat, **context):
+        if len(context) > 0:
+            return self._character.get_stat(stat, **context)
+        return self._lookup(stat)
+
+    def __getattr__(self, item):
+        return getattr(self._character, item)
+
+
+class StatsPlan(object):
+    """Flat evaluation plan for the stats of a character.
+
+    Stat dependencies (e.g. regen_5SR on intellect and spirit) are discovered once by tracing the lookups made by
+    the modifiers, evaluating them against base values. Stats are then evaluated in topological order, in one pass.
+    Modifiers lookup their dependencies without context (as in Character.get_stat), so only the requested stats are
+    evaluated with the context.
+    """
+    def __init__(self, character, stats=None):
+        self._character = character
+        self._stats = list(Stats.all_stats() if stats is None else stats)
+        self._dependencies = self._discover_dependencies()
+        self._order = self._topological_order()
+
+    @property
+    def dependencies(self):
+        return self._dependencies
+
+    @property
+    def order(self):
+        return self._order
+
+    def _discover_dependencies(self):
+        dependencies = dict()
+        to_visit = list(self._stats)
+        while len(to_visit) > 0:
+            stat = to_visit.pop()
+            if stat in dependencies:
+                continue
+            found = list()
+
+            def lookup(dependency):
+                found.append(dependency)
+                return self._character.get_base_stat(dependency)
+
+            proxy = _StatsProxy(self._character, lookup)
+            self._character.stats_effects.apply(stat, self._character.get_base_stat(stat), proxy)
+            dependencies[stat] = set(found)
+            to_visit.extend(found)
+        return dependencies
+
+    def _topological_order(self):
+        order, done, path = list(), set(), list()
+
+        def visit(stat):
+            if stat in done:
+                return
+            if stat in path:
+                cycle = path[path.index(stat):] + [stat]
+                raise ValueError("cyclic stat dependency: {}".format(" -> ".join(cycle)))
+            path.append(stat)
+            for dependency in sorted(self._dependencies[stat]):
+                visit(dependency)
+            path.pop()
+            done.add(stat)
+            order.append(stat)
+
+        for stat in self._stats:
+            visit(stat)
+        return order
+
+    def evaluate(self, **context):
+        """returns a dictionary mapping stats with their value"""
+        values = dict()
+        proxy = _StatsProxy(self._character, lambda s: values[s] if s in values else self._character.get_stat(s))
+        effects = self._character.stats_effects
+        for stat in self._order:
+            values[stat] = effects.apply(stat, self._character.get_base_stat(stat), proxy)
+        if len(context) == 0:
+            return {stat: values[stat] for stat in self._stats}
+        return {stat: effects.apply(stat, self._character.get_base_stat(stat), proxy, **context) for stat in self._stats}
+
+
 def druid_stats():
     buffs = list()
 
     # regen 5-sec rule
     buffs.append(StatsModifier(
         name=Stats.REGEN_5SR, stats=[Stats.REGEN_5SR], _type=StatsModifier.TYPE_ADDITIVE,
-        functions=[lambda char, **context: 5 * 0.00932715221261 * math.sqrt(char.get_stat(Stats.INTELLECT)) * char.get_stat(
+        functions=[lambda char, **context: 5 * 0.00932715221261 * sqrt(char.get_stat(Stats.INTELLECT)) * char.get_stat(
             Stats.SPIRIT)],
         formula=["5 * 0.00932715221261 * SQRT(#Stats.{}#) * #Stats.{}#".format(Stats.INTELLECT, Stats.SPIRIT)])
     )
@@ -125,7 +269,7 @@ def druid_stats():
     ))
     buffs.append(StatsModifier(
         name=Stats.MANA + "_intel", stats=[Stats.MANA], _type=StatsModifier.TYPE_ADDITIVE,
-        functions=[lambda char, **context: 15 * max(0, char.get_stat(Stats.INTELLECT) - 20) + min(20, char.get_stat(
+        functions=[lambda char, **context: 15 * maximum(0, char.get_stat(Stats.INTELLECT) - 20) + minimum(20, char.get_stat(
             Stats.INTELLECT))],
         formula=["(15 * MAX(0; #Stats.{intel}# - 20) + MIN(20; #Stats.{intel}#))".format(intel=Stats.INTELLECT)]
     ))
@@ -141,6 +285,7 @@ def druid_base():
 
 class DruidCharacter(Character):
     def __init__(self, stats, talents: Talents, stats_buffs: StatsModifierArray, spell_buffs: StatsModifierArray, gear: Gear=None, level=70):
+        super().__init__()
         self._level = level
         self._talents = talents
         self._stats_buffs = stats_buffs
@@ -190,6 +335,7 @@ class DruidCharacter(Character):
 
 class BuffedCharacter(Character, ABC):
     def __init__(self, character, stats_buffs=None, spell_buffs=None):
+        super().__init__()
         self._character = character
         self._other_stats_buffs = stats_buffs
         self._other_spell_buffs = spell_buffs
@@ -237,8 +383,36 @@ class BuffedCharacter(Character, ABC):
         return self._character.base_stats
 
 
+def batch_stat_sheet(base_stats, talents: Talents, stats_buffs: StatsModifierArray, spell_buffs: StatsModifierArray,
+                     gear: Gear=None, level=70, **context):
+    """Evaluate the stats of many character variants sharing talents, buffs and gear in one pass.
+
+    Parameters:
+    -----------
+    base_stats: np.ndarray
+        Structured array with one row per variant and one field per base stat (missing stats are 0)
+    context:
+        Spell context (e.g. spell_name, spell_part) for which the stats should be evaluated
+
+    Returns:
+    --------
+    sheet: np.ndarray
+        Structured array with one row per variant and one field per stat of Stats.all_stats()
+    """
+    unknown = set(base_stats.dtype.names).difference(Stats.all_stats())
+    if len(unknown) > 0:
+        raise ValueError("unknown stats in base stats: {}".format(", ".join(sorted(unknown))))
+    columns = {stat: np.asarray(base_stats[stat], dtype=float) for stat in base_stats.dtype.names}
+    character = DruidCharacter(columns, talents=talents, stats_buffs=stats_buffs, spell_buffs=spell_buffs, gear=gear, level=level)
+    sheet = np.zeros(base_stats.shape[0], dtype=[(stat, float) for stat in Stats.all_stats()])
+    for stat, values in character.stat_sheet(**context).items():
+        sheet[stat] = values
+    return sheet
+
+
 # character with all bonuses
 def create_full_druid_character():
+    from items import ALL_ITEMS_GEAR
     return DruidCharacter(
         dict(),
         talents=DruidTalents({k: v for k, v, _ in DruidTalents.all()}),
@@ -247,4 +421,9 @@ def create_full_druid_character():
         gear=ALL_ITEMS_GEAR, level=70)
 
 
-FULL_DRUID = create_full_druid_character()
\ No newline at end of file
+def __getattr__(name):
+    """character with all bonuses (FULL_DRUID) is only built on first access"""
+    if name == "FULL_DRUID":
+        globals()[name] = create_full_druid_character()
+        return globals()[name]
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
\ No newline at end of file
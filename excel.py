@@ -1,7 +1,12 @@
+import functools
+import json
 import os
 import re
+import sqlite3
+import tempfile
 from abc import abstractmethod
-from collections import defaultdict
+
+import numpy as np
 
 from xlsxwriter import Workbook
 from xlsxwriter.utility import xl_rowcol_to_cell
@@ -10,6 +15,7 @@ from buffs import ALL_STATS_BUFFS, PLAYER_BUFFS, TARGET_BUFFS, Buff, CONSUMABLES
 from character import Stats
 from heal_parts import HealParts
 from items import ALL_SPELL_ITEMS, ALL_STATS_ITEMS
+from rotation import FORMULA_TOKENS
 from spell import HealingSpell, HEALING_TOUCH, REJUVENATION, REGROWTH, LIFEBLOOM, TRANQUILITY
 from talents import DruidTalents
 
@@ -23,20 +29,55 @@ def parse_spell_formula(formula, spell, cell_map, ignore_missing=False):
 
 
 def parse_formula(formula, cell_map, ignore_missing=False):
-    pattern = re.compile(r"#([a-zA-Z_0-9 -]+)\.([a-zA-Z_0-9 -]+)#")
-    array = []
-    start = 0
-    for match in pattern.finditer(formula):
-        mstart, mend = match.regs[0][0], match.regs[-1][1]
-        key = (match.group(1), match.group(2))
-        array.append(formula[start:mstart])
-        if key not in cell_map and ignore_missing:
-            array.append("#{}.{}#".format(*key))
-        else:
-            array.append(cell_map[key])
-        start = mend + 1
-    array.append(formula[start:])
-    return "".join(array)
+    return FormulaTemplate.parse(formula).substitute(
+        (cell_map, FormulaTemplate.MISSING_KEEP if ignore_missing else FormulaTemplate.MISSING_RAISE))
+
+
+class FormulaTemplate(object):
+    """A formula split once into literal segments and the (group, key) of its #Group.key# references.
+
+    substitute(*layers) replaces the references in a single join. A layer is a (cell_map, missing) pair, the layers
+    are looked up in order and `missing` tells what to do when a reference is not in a layer:
+    - MISSING_NEXT: look it up in the next layer
+    - MISSING_KEEP: leave the reference in the formula
+    - MISSING_RAISE: raise a KeyError"""
+    PATTERN = re.compile(r"#([a-zA-Z_0-9 -]+)\.([a-zA-Z_0-9 -]+)#")
+    MISSING_NEXT = "next"
+    MISSING_KEEP = "keep"
+    MISSING_RAISE = "raise"
+
+    def __init__(self, formula):
+        parts = FormulaTemplate.PATTERN.split(formula)
+        self._literals = parts[0::3]
+        self._keys = list(zip(parts[1::3], parts[2::3]))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse(formula):
+        """parsed template of the formula, formulas are few and reused for every row (spells, comparison columns) so
+        the most recently used ones are kept"""
+        return FormulaTemplate(formula)
+
+    @property
+    def keys(self):
+        return self._keys
+
+    @staticmethod
+    def _lookup(key, layers):
+        for cell_map, missing in layers:
+            if key in cell_map:
+                return cell_map[key]
+            if missing == FormulaTemplate.MISSING_KEEP:
+                return "#{}.{}#".format(*key)
+            if missing == FormulaTemplate.MISSING_RAISE:
+                break
+        raise KeyError(key)
+
+    def substitute(self, *layers):
+        if len(self._keys) == 0:
+            return self._literals[0]
+        values = [self._lookup(key, layers) for key in self._keys]
+        return "".join([part for pair in zip(self._literals, values) for part in pair] + [self._literals[-1]])
 
 
 class ThematicSheet(object):
@@ -644,15 +685,90 @@ def gem_policy_str(gp):
     return "_".join(map(lambda k: str(gp[k]), sorted(gp.keys())))
 
 
+class ComparisonRecords(object):
+    """Compact records of the combinations of a comparison (see main.compact_record), spooled to a temporary SQLite
+    file of `folder` as they arrive and read back in the order of the summary sheet: one row per character, talents,
+    buffs and gems policy, one group of columns per assignments. Memory use does not grow with the number of records.
+
+    Combinations are keyed by their index: when the names of the configuration give several combinations the same
+    labels, the one with the highest index is written, as the sheet has a single cell for them."""
+    def __init__(self, folder):
+        handle, self._path = tempfile.mkstemp(prefix="compare-", suffix=".sqlite", dir=folder)
+        os.close(handle)
+        self._connection = sqlite3.connect(self._path)
+        self._connection.execute("PRAGMA journal_mode = OFF")
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.execute("""CREATE TABLE records (
+            id INTEGER PRIMARY KEY,
+            character TEXT NOT NULL,
+            spec TEXT NOT NULL,
+            buffs TEXT NOT NULL,
+            gems TEXT NOT NULL,
+            assignments TEXT NOT NULL,
+            record TEXT NOT NULL
+        )""")
+
+    @staticmethod
+    def row_key(record):
+        return record["character"], record["spec"], record["buffs"], gem_policy_str(record["gems"])
+
+    @staticmethod
+    def sheet_fields(record):
+        """the part of a record written in the summary sheet (top level stats, no per target stats)"""
+        return {
+            "description": record["description"],
+            "gems": record["gems"],
+            "stats": {k: v for k, v in record["stats"].items() if not isinstance(v, dict)},
+            "stat_sheet": record["stat_sheet"],
+            "base_stats": record["base_stats"],
+            "gem_slots": [{"colors": slots["colors"]} for slots in record["gem_slots"]]
+        }
+
+    def add(self, index, record):
+        """add the record of the index-th combination"""
+        self._connection.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (index, ) + self.row_key(record) +
+                                 (record["assignments"], json.dumps(self.sheet_fields(record))))
+
+    def assignments(self):
+        return [name for name, in self._connection.execute(
+            "SELECT DISTINCT assignments FROM records ORDER BY assignments")]
+
+    def __len__(self):
+        return self._connection.execute(
+            "SELECT COUNT(*) FROM (SELECT DISTINCT character, spec, buffs, gems FROM records)").fetchone()[0]
+
+    def rows(self):
+        """generate (row key, {assignments name: record}) in row order, of duplicate labels the last record is kept"""
+        key, row = None, dict()
+        for values in self._connection.execute("""SELECT character, spec, buffs, gems, assignments, record FROM records
+                                                  ORDER BY character, spec, buffs, gems, assignments, id"""):
+            if values[:4] != key:
+                if key is not None:
+                    yield key, row
+                key, row = values[:4], dict()
+            row[values[4]] = json.loads(values[5])
+        if key is not None:
+            yield key, row
+
+    def close(self):
+        self._connection.close()
+        os.remove(self._path)
+
+
 class ComparisonSummarySheet(ThematicSheet):
-    def __init__(self, workbook, sheet, cell_map, combinations, cell_maps, duration, stats_columns=None, offset=(0, 0)):
+    """Summary of the combinations of ComparisonRecords, written row after row so that the workbook can be streamed
+    (xlsxwriter constant_memory mode only keeps the current row)"""
+    SLOT_COLORS = ["meta", "red", "blue", "yellow"]
+
+    def __init__(self, workbook, sheet, cell_map, records, duration, stats_columns=None, offset=(0, 0)):
         super().__init__(workbook, sheet, cell_map, offset)
-        self._combinations = {(c[1], c[3].talents.name, c[3].stats_buffs.name, c[4].name, gem_policy_str(c[7])): c for c in combinations}
-        self._a_names = sorted(list({c[4].name for c in combinations}))
-        self._o_names = sorted(list({(c[1], c[3].talents.name, c[3].stats_buffs.name, gem_policy_str(c[7])) for c in combinations}))
-        self._all_cell_maps = cell_maps
+        self._records = records
+        self._a_names = records.assignments()
+        self._n_combination_rows = len(records)
         self._stats_columns = ["hps", "ttoom", "mps", "total"] if stats_columns is None else stats_columns
         self._fight_duration = duration
+        self._total = FormulaTemplate.parse("(MIN(#Comp.ttoom#, #Fight.duration#) * #Comp.hps#)")
 
     @property
     def n_cols(self):
@@ -660,116 +776,82 @@ class ComparisonSummarySheet(ThematicSheet):
 
     @property
     def n_rows(self):
-        return len(self._combinations) + 2
+        return self._n_combination_rows + 2
 
     @property
     def n_stats_columns(self):
         return len(self._stats_columns)
 
     @staticmethod
-    def to_formula(heals, over_time=None):
-        heal_dict = defaultdict(lambda: 0)
-        for heal_tokken in heals:
-            heal_dict[heal_tokken] += 1
-        f = "+".join(["({mult} * ({form}))".format(mult=mult, form=form) for form, mult in heal_dict.items()])
+    def to_formula(heal_tokens, over_time=None):
+        token_ids, counts = np.unique(heal_tokens, return_counts=True)
+        forms = FORMULA_TOKENS.resolve(token_ids)
+        f = "+".join(["({mult} * ({form}))".format(mult=mult, form=form) for form, mult in zip(forms, counts)])
         if over_time is None:
             return "(" + f + ")"
         return "({})/{}".format(f, over_time)
 
-    def write_sheet(self):
+    def write_header(self):
         first_row, first_col = self._offset
-
-        # headers
         self.write_cell(first_row, first_col, "Duration")
         self.write_cell_and_map(first_row, first_col + 1, self._fight_duration, "Fight", "duration")
-        col = self.write_cell(first_row + 1, first_col, "Gear")
-        col = self.write_cell(first_row + 1, col + 1, "Talents")
-        col = self.write_cell(first_row + 1, col + 1, "Buffs")
-        self._worksheet.merge_range(first_row, col + 1, first_row, col + 3, "Gems")
-        col = self.write_cell(first_row + 1, col + 1, "Policy")
-        col = self.write_cell(first_row + 1, col + 1, "Heroic")
-        col = self.write_cell(first_row + 1, col + 1, "Jewelcrafting")
-
-        for j, a_name in enumerate(self._a_names):
-            self._worksheet.merge_range(first_row, col + 1, first_row, col + 1 + self.n_stats_columns - 1, a_name)
-            for jj, col_name in enumerate(self._stats_columns):
-                col = self.write_cell(first_row + 1, col + 1, col_name)
-
-        col = self.write_cell(first_row + 1, col + 1, "Gear")
+        self._worksheet.merge_range(first_row, first_col + 3, first_row, first_col + 5, "Gems")
+        col = first_col + 5
+        for a_name in self._a_names:
+            self._worksheet.merge_range(first_row, col + 1, first_row, col + self.n_stats_columns, a_name)
+            col += self.n_stats_columns
+
+        headers = ["Gear", "Talents", "Buffs", "Policy", "Heroic", "Jewelcrafting"]
+        headers += self._stats_columns * len(self._a_names)
+        headers += ["Gear"] + [self.human_readable(stat) for stat in Stats.all_stats()] * 2 + self.SLOT_COLORS
+        for j, header in enumerate(headers):
+            self.write_cell(first_row + 1, first_col + j, header)
+
+    def write_row(self, row, key, records):
+        """write a row from the records of its combinations, by assignments name"""
+        c_name, t_name, b_name, _ = key
+        # records of a row share their character, talents, buffs and gems
+        first = next(iter(records.values()))
+        gems_policy = first["gems"]
+        col = self.offset_col - 1
+        for value in [c_name, t_name, b_name, gems_policy["policy"], gems_policy["heroic"], gems_policy["jewelcrafting"]]:
+            col = self.write_cell(row, col + 1, value)
+
+        for a_name in self._a_names:
+            if a_name not in records:
+                col += self.n_stats_columns
+                continue
+            stats = records[a_name]["stats"]
+            # references to the cells of the combination are relative, the fight duration is absolute
+            comp = dict()
+            for stats_name in self._stats_columns:
+                formula = False
+                if stats_name == "total":
+                    content = self._total.substitute((comp, FormulaTemplate.MISSING_NEXT),
+                                                     (self.cell_map, FormulaTemplate.MISSING_RAISE))
+                    formula = True
+                elif stats_name == "ttoom":
+                    content = stats["time2oom"]
+                    if content < 0:
+                        content = "inf"
+                else:
+                    content = stats[stats_name]
+                col = self.write_cell(row, col + 1, content, formula=formula)
+                comp[("Comp", stats_name)] = sheet_cell_ref(self.worksheet, row, col).replace("$", "")
+
+        col = self.write_cell(row, col + 1, "HYPERLINK(\"{}\")".format(first["description"]), formula=True)
         for stat in Stats.all_stats():
-            col = self.write_cell(first_row + 1, col + 1, self.human_readable(stat))
-
+            col = self.write_cell(row, col + 1, first["stat_sheet"][stat])
         for stat in Stats.all_stats():
-            col = self.write_cell(first_row + 1, col + 1, self.human_readable(stat))
-
-        slot_colors = ["meta", "red", "blue", "yellow"]
-        for color in slot_colors:
-            col = self.write_cell(first_row + 1, col + 1, color)
-
-        # data
-        for i, (c_name, t_name, b_name, g_name) in enumerate(self._o_names):
-            col = self.write_cell(first_row + 2 + i, first_col, c_name)
-            col = self.write_cell(first_row + 2 + i, col + 1, t_name)
-            col = self.write_cell(first_row + 2 + i, col + 1, b_name)
-            gems_policy = self._combinations[(c_name, t_name, b_name, self._a_names[0], g_name)][7]
-            col = self.write_cell(first_row + 2 + i, col + 1, gems_policy["policy"])
-            col = self.write_cell(first_row + 2 + i, col + 1, gems_policy["heroic"])
-            col = self.write_cell(first_row + 2 + i, col + 1, gems_policy["jewelcrafting"])
-
-            for j, a_name in enumerate(self._a_names):
-                group = "{}-Comp-{}".format(i, a_name)
-                (ref, _, _, character, assignments, rotation, stats, gems_policy) = self._combinations[(c_name, t_name, b_name, a_name, g_name)]
-                for jj, stats_name in enumerate(self._stats_columns):
-                    formula = False
-                    if stats_name == "total":
-                        content = "(MIN(#{grp}.ttoom#, ???) * #{grp}.hps#)".format(grp=group)
-                        formula = True
-                    elif stats_name == "ttoom":
-                        content = stats["time2oom"]
-                        if content < 0:
-                            content = "inf"
-                    else:
-                        content = stats[stats_name]
-                    if formula:
-                        content = parse_formula(content, self.cell_map, ignore_missing=True)
-                        content = parse_formula(content, cell_map=self._all_cell_maps[ref])
-                        content = content.replace("$", "")
-                        content = content.replace("???", "#Fight.duration#")
-                        content = parse_formula(content, self.cell_map, ignore_missing=False)
-
-                    col = self.write_cell_and_map(
-                        first_row + 2 + i,
-                        col + 1,
-                        content,
-                        group, stats_name,
-                        formula=formula
-                    )
-
-            desc = self._combinations[(c_name, t_name, b_name, self._a_names[0], g_name)][2]
-            col = self.write_cell(first_row + i + 2, col + 1, "HYPERLINK(\"{}\")".format(desc), formula=True)
-
-            character = self._combinations[(c_name, t_name, b_name, self._a_names[0], g_name)][3]
-            for stat in Stats.all_stats():
-                col = self.write_cell(first_row + i + 2, col + 1, character.get_stat(stat))
-
-            for stat in Stats.all_stats():
-                col = self.write_cell(first_row + i + 2, col + 1, character.get_base_stat(stat))
-
-            all_slots = character.gear.gem_slots.slots
-            for color in slot_colors:
-                n_slots = len([c for slots in all_slots for c in slots.colors if c == color])
-                col = self.write_cell(first_row + i + 2, col + 1, n_slots)
-
-
-        # for j, c_name in enumerate(self._c_names):
-        #     self.write_cell(first_row, first_col + j + 1, c_name)
-        #     for jj, a_name in enumerate(self._a_names):
-        #         merged_name = "{}_{}".format(c_name, a_name)
-        #         _, character, _, _, assignments, _, stats = self._combinations[(c_name, a_name)]
-        #
-        #         formula = ComparisonSummarySheet.to_formula(stats["string_heals"], over_time=stats["duration"])
-        #         parsed = parse_formula(formula, cell_map=self._all_cell_maps[merged_name])
-        #         self.write_cell(first_row + 1 + i, first_col + 1 + j, parsed, formula=True)
+            col = self.write_cell(row, col + 1, first["base_stats"][stat])
+        for color in self.SLOT_COLORS:
+            n_slots = len([c for slots in first["gem_slots"] for c in slots["colors"] if c == color])
+            col = self.write_cell(row, col + 1, n_slots)
+
+    def write_sheet(self):
+        self.write_header()
+        for i, (key, records) in enumerate(self._records.rows()):
+            self.write_row(self.offset_row + 2 + i, key, records)
 
 
 def write_spell_charac_sheet(workbook, name, character, offset=(0, 0)):
@@ -803,13 +885,9 @@ def write_spells_wb(character, name, outfolder):
     wb.close()
 
 
-def write_compare_setups_wb(configs, fight_duration, outfolder):
-    wb = Workbook(os.path.join(outfolder, "compare.xlsx"))
-    cell_maps = defaultdict(lambda: dict())
-    # for i, (c_name, c_descr, character, assigments, rotation, stats) in enumerate(configs):
-    #     sheet, cm = write_spell_charac_sheet(wb, "{}".format(i + 1), character, offset=(1, 0))
-    #     cell_maps[str(i + 1)].update(cm)
-    configs = [(str(i + 1), ) + c for i, c in enumerate(configs)]
-    comp = ComparisonSummarySheet.create_new_sheet(wb, "summary", dict(), configs, cell_maps, fight_duration)
+def write_compare_setups_wb(records, fight_duration, outfolder):
+    """write the summary of the ComparisonRecords, streamed to disk row by row"""
+    wb = Workbook(os.path.join(outfolder, "compare.xlsx"), {"constant_memory": True})
+    comp = ComparisonSummarySheet.create_new_sheet(wb, "summary", dict(), records, fight_duration)
     comp.write_sheet()
     wb.close()
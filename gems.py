@@ -38,6 +38,10 @@ class ItemGemSlots(object):
         self._gems = [None] * len(slots)
         self._bonus = bonus
 
+    @property
+    def name(self):
+        return self._name
+
     @property
     def colors(self):
         return self._slots
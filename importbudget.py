@@ -0,0 +1,43 @@
+import json
+import re
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# maximum import time (seconds) of the modules loaded by simulation runs and joblib workers
+IMPORT_BUDGETS = {"main": 0.4, "rotation": 0.3}
+# modules that must only be imported when needed (-g, -s, parallel runs)
+DEFERRED_MODULES = ["matplotlib", "xlsxwriter", "joblib", "cloudpickle"]
+
+
+def measure_import(module):
+    """(cumulative import time in seconds, deferred modules that were imported) of a module in a fresh interpreter"""
+    code = "import sys, json, {}; print(json.dumps([m for m in {} if m in sys.modules]))".format(module, DEFERRED_MODULES)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    match = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| {}$".format(re.escape(module)), process.stderr, re.MULTILINE)
+    if match is None:
+        raise ValueError("no import time reported for module '{}'".format(module))
+    return int(match.group(1)) / 1e6, json.loads(process.stdout)
+
+
+def main(argv):
+    parser = ArgumentParser()
+    parser.add_argument("-r", "--repeat", dest="repeat", default=5, type=int)
+    parser.add_argument("--scale", dest="scale", default=1.0, type=float, help="multiply budgets (slow machines)")
+    args, _ = parser.parse_known_args(argv)
+
+    over_budget = False
+    for module, budget in IMPORT_BUDGETS.items():
+        measures = [measure_import(module) for _ in range(args.repeat)]
+        best = min(t for t, _ in measures)
+        deferred = sorted({m for _, loaded in measures for m in loaded})
+        ok = best <= budget * args.scale and len(deferred) == 0
+        over_budget |= not ok
+        print("{: <10} {:6.3f}s (budget {:.3f}s) {}{}".format(
+            module, best, budget * args.scale, "ok" if ok else "FAILED",
+            "" if len(deferred) == 0 else ", imports " + ", ".join(deferred)))
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -246,7 +246,14 @@ _spell_items = [
 
 ALL_STATS_ITEMS = {item.name: item for item in _stats_items}
 ALL_SPELL_ITEMS = {item.name: item for item in _spell_items}
-ALL_ITEMS_GEAR = Gear(list(ALL_STATS_ITEMS.values()), list(ALL_SPELL_ITEMS.values()))
+
+
+def __getattr__(name):
+    """gear with all items (ALL_ITEMS_GEAR) is only built on first access"""
+    if name == "ALL_ITEMS_GEAR":
+        globals()[name] = Gear(list(ALL_STATS_ITEMS.values()), list(ALL_SPELL_ITEMS.values()))
+        return globals()[name]
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
 
 
 def get_items(names):
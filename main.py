@@ -1,20 +1,21 @@
-import itertools
 import json
 import os
 import sys
+import time
+import traceback
 from argparse import ArgumentParser
 
-from joblib import Parallel, delayed
-
 from buffs import ALL_STATS_BUFFS, ALL_SPELL_BUFFS
 from gems import GemSlotsCollection, ItemGemSlots, optimize_slots
 from items import Gear, get_items, ALL_ON_USE_ITEMS
 from statsmodifiers import StatsModifierArray, ConstantStatsModifier, StatsModifier
-from character import DruidCharacter, FULL_DRUID
-from excel import write_compare_setups_wb, write_spells_wb
-from plot import plot_rotation
-from rotation import Rotation, Assignments, make_on_use_timelines
+from character import DruidCharacter
+from resultcache import ResultCache
+from rotation import Rotation, Assignments, make_on_use_timelines, serializable_stats
+from statistics import Stats
+from sweep import estimate_cost, expand_combinations, make_batches, run_batch, Utilization
 from talents import DruidTalents
+from workqueue import WorkQueue, LeaseHeartbeat, worker_name, STATUS_PENDING, STATUS_RUNNING, STATUS_DONE
 
 
 def parse_gems_slots(gems_data):
@@ -29,28 +30,72 @@ def parse_gems_slots(gems_data):
     ])
 
 
-def sim_loop(i, n_comb, charac_info, buffs, talents, assignments, gems_policy, fight_duration, plot_graphs, out_folder, plot_gems):
+def summary_stats(stats):
+    """rotation stats without the per-tick series (only scalars, nested in the same dictionaries)"""
+    summary = dict()
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            summary[key] = summary_stats(value)
+        elif isinstance(value, (int, float, str, bool)) or value is None:
+            summary[key] = value
+    return summary
+
+
+def compact_record(charac_info, character, assignments, stats, gems_policy, gem_slots):
+    """output record of a combination, small enough to be cheaply sent back by workers"""
+    return {
+        "character": charac_info["name"],
+        "description": charac_info["description"],
+        "stats": summary_stats(stats),
+        "gems": gems_policy,
+        "spec": character.talents.name,
+        "assignments": assignments.name,
+        "buffs": character.stats_buffs.name,
+        "stat_sheet": {stat: float(value) for stat, value in character.stat_sheet().items()},
+        "base_stats": {stat: character.get_base_stat(stat) for stat in Stats.all_stats()},
+        "gem_slots": [{"item": slots.name, "colors": slots.colors, "gems": [gem.name for gem in slots.gems]}
+                      for slots in gem_slots.slots]
+    }
+
+
+def prepare_gear(characters, gems_policies, pairs, plot_gems=False):
+    """gear of the given (character index, gems policy index) pairs. Items are looked up once per character and gems
+    optimized once per pair, instead of once per combination"""
+    all_gear = dict()
+    all_items = dict()
+    for c, g in pairs:
+        charac_info, gems_policy = characters[c], gems_policies[g]
+        if c not in all_items:
+            all_items[c] = get_items(charac_info.get("bonuses"))
+        gem_slots = optimize_slots(
+            slots=parse_gems_slots(charac_info["gems"]),
+            strategy=gems_policy["policy"],
+            heroic=gems_policy["heroic"],
+            jewelcrafting=gems_policy["jewelcrafting"]
+        )
+        if plot_gems:
+            print("char:{} gems:{}".format(charac_info["name"], "_".join(map(str, gems_policy.values()))))
+            for item_slots in gem_slots.slots:
+                print(", ".join(["{}:{}".format(color, gem.name) for color, gem in zip(item_slots.colors, item_slots.gems)]))
+        all_gear[(c, g)] = Gear(*all_items[c], gem_slots)
+    return all_gear
+
+
+def sim_loop(i, n_comb, charac_info, buffs, talents, assignments, gems_policy, gear, fight_duration, plot_graphs, out_folder,
+             compact=False):
+    """simulate a combination, returns the full simulation objects or, with compact, only its output record"""
     stats_buffs, spell_buffs = buffs
     gems_policy_str = "_".join(map(str, gems_policy.values()))
     print("#{: <3} ({:3.2f}%) char:{} buffs:{} tal:{} assign:{} gems:{}".format(i + 1, 100 * i / n_comb,
                                                                                 charac_info["name"], stats_buffs.name,
                                                                                 talents.name, assignments.name,
                                                                                 gems_policy_str))
-    gem_slots = optimize_slots(
-        slots=parse_gems_slots(charac_info["gems"]),
-        strategy=gems_policy["policy"],
-        heroic=gems_policy["heroic"],
-        jewelcrafting=gems_policy["jewelcrafting"]
-    )
-    if plot_gems:
-        for item_slots in gem_slots.slots:
-            print(", ".join(["{}:{}".format(c, g.name) for c, g in zip(item_slots.colors, item_slots.gems)]))
     character = DruidCharacter(
         stats=charac_info["stats"],
         talents=talents,
         stats_buffs=stats_buffs,
         spell_buffs=spell_buffs,
-        gear=Gear(*get_items(charac_info.get("bonuses")), gem_slots),
+        gear=gear,
         level=charac_info["level"]
     )
     comb_name = "_".join([charac_info["name"], talents.name, stats_buffs.name, assignments.name, gems_policy_str])
@@ -61,57 +106,286 @@ def sim_loop(i, n_comb, charac_info, buffs, talents, assignments, gems_policy, f
                                              rotation.cast_timeline)
     stats = rotation.stats(character, start=0, end=fight_duration, on_use=on_use_timelines)
     if plot_graphs:
+        from plot import plot_rotation
         plot_rotation(
             path=os.path.join(out_folder, "{}.png".format(comb_name)),
             rotation=rotation,
             maxx=fight_duration,
             on_use=on_use_timelines
         )
+    if compact:
+        return compact_record(charac_info, character, assignments, stats, gems_policy, gear.gem_slots)
     return charac_info["name"], charac_info["description"], character, assignments, rotation, stats, gems_policy
 
 
+def write_record(stream, record):
+    """append a record as one json line, written and flushed at once so that a killed run only loses the last line"""
+    stream.write(json.dumps(record) + "\n")
+    stream.flush()
+
+
+def build_axes(_in):
+    """buffs, talents and assignments of a configuration"""
+    all_buffs = []
+    for buff in _in["buffs"]:
+        all_buffs.append((
+            StatsModifierArray([ALL_STATS_BUFFS[b] for b in buff["active"] if b in ALL_STATS_BUFFS], name=buff["name"]),
+            StatsModifierArray([ALL_SPELL_BUFFS[b] for b in buff["active"] if b in ALL_SPELL_BUFFS], name=buff["name"])
+        ))
+    all_talents = [DruidTalents(talent["points"], name=talent["name"]) for talent in _in["talents"]]
+    all_assignments = [Assignments.from_dict(rotation) for rotation in _in["rotations"]]
+    return all_buffs, all_talents, all_assignments
+
+
+def combination_record(combination, compact=False):
+    """output record of a sim_loop result"""
+    if compact:
+        return combination
+    c_name, c_info, char, assignments, _, stats, gems = combination
+    return {"character": c_name, "description": c_info, "stats": serializable_stats(stats), "gems": gems,
+            "spec": char.talents.name, "assignments": assignments.name}
+
+
+def sheet_record(combination, compact=False):
+    """compact record of a sim_loop result, as written to the comparison spreadsheet"""
+    if compact:
+        return combination
+    c_name, c_info, char, assignments, _, stats, gems = combination
+    return compact_record({"name": c_name, "description": c_info}, char, assignments, stats, gems, char.gear.gem_slots)
+
+
+def warn_duplicate_labels(_in, cells):
+    """warn about combinations that have the same labels (names of the configuration) as a later combination, the
+    comparison spreadsheet only shows the last one"""
+    from excel import gem_policy_str
+    last = dict()
+    for i, (c, b, t, a, g) in enumerate(cells):
+        last[(_in["characters"][c]["name"], _in["talents"][t]["name"], _in["buffs"][b]["name"],
+              gem_policy_str(_in["gems_policy"][g]), _in["rotations"][a]["name"])] = i
+    hidden = len(cells) - len(last)
+    if hidden > 0:
+        print("warning: {} combinations have the same character, talents, buffs, gems and rotation names as a later "
+              "one and are not shown in the comparison spreadsheet (they are in the output json)".format(hidden))
+
+
+def comparison_records(out_folder):
+    """spool of the records of the comparison spreadsheet (see write_spreadsheets)"""
+    from excel import ComparisonRecords
+    return ComparisonRecords(out_folder)
+
+
+def write_spreadsheets(sheet_records, fight_duration, out_folder):
+    from character import FULL_DRUID
+    from excel import write_compare_setups_wb, write_spells_wb
+    write_spells_wb(FULL_DRUID, "spells", outfolder=out_folder)
+    write_compare_setups_wb(sheet_records, fight_duration, outfolder=out_folder)
+
+
+def write_output_json(records, out_folder):
+    with open(os.path.join(out_folder, "output.json"), mode="w+", encoding="utf8") as file:
+        json.dump(records, file)
+
+
+def fill_queue(queue_path, _in, out_folder, graphs=False, spreadsheets=False, compact=False):
+    """write all combinations of the configuration in a new work queue"""
+    _, _, all_assignments = build_axes(_in)
+    cells = list(expand_combinations(_in))
+    tasks = [(i, cell, estimate_cost(all_assignments[cell[3]], len(_in["characters"][cell[0]].get("on_use", [])),
+                                     _in["fight_duration"]))
+             for i, cell in enumerate(cells)]
+    if spreadsheets:
+        warn_duplicate_labels(_in, cells)
+    queue = WorkQueue(queue_path)
+    queue.fill({"config": _in, "n_comb": len(cells), "out_folder": out_folder, "graphs": graphs,
+                "spreadsheets": spreadsheets, "compact": compact}, tasks)
+    queue.close()
+    print("{} combinations queued in {}".format(len(tasks), queue_path))
+
+
+def work_queue(queue_path, poll=5):
+    """claim and simulate queued combinations until none is left to claim or waiting for an expired lease"""
+    queue = WorkQueue(queue_path)
+    meta = queue.meta
+    _in = meta["config"]
+    all_buffs, all_talents, all_assignments = build_axes(_in)
+    all_gear = dict()
+    owner = worker_name()
+    while True:
+        task = queue.claim(owner)
+        if task is None:
+            counts = queue.counts()
+            if counts[STATUS_PENDING] + counts[STATUS_RUNNING] == 0:
+                break
+            time.sleep(poll)
+            continue
+        i, (c, b, t, a, g) = task
+        try:
+            with LeaseHeartbeat(queue_path, i, owner):
+                if (c, g) not in all_gear:
+                    all_gear.update(prepare_gear(_in["characters"], _in["gems_policy"], [(c, g)]))
+                combination = sim_loop(i, meta["n_comb"], _in["characters"][c], all_buffs[b], all_talents[t],
+                                       all_assignments[a], _in["gems_policy"][g], all_gear[(c, g)],
+                                       _in["fight_duration"], meta["graphs"], meta["out_folder"], compact=meta["compact"])
+                record = combination_record(combination, compact=meta["compact"])
+                artifact = None
+                if meta["spreadsheets"] and not meta["compact"]:
+                    artifact = sheet_record(combination)
+        except Exception:
+            queue.fail(i, owner, traceback.format_exc())
+            continue
+        if not queue.complete(i, owner, record, artifact):
+            print("lease of combination #{} was lost, result dropped".format(i + 1))
+    queue.close()
+
+
+def merge_queue(queue_path, out_folder=None):
+    """write the outputs of a completed work queue"""
+    queue = WorkQueue(queue_path)
+    meta = queue.meta
+    counts = queue.counts()
+    if counts[STATUS_DONE] != meta["n_comb"]:
+        errors = "".join(["\n#{}: {}".format(i + 1, error) for i, error in queue.errors()])
+        raise ValueError("work queue '{}' is not complete: {}{}".format(queue_path, counts, errors))
+    out_folder = meta["out_folder"] if out_folder is None else out_folder
+    os.makedirs(out_folder, exist_ok=True)
+    records = list()
+    sheet_records = comparison_records(out_folder) if meta["spreadsheets"] else None
+    try:
+        for task_id, record, artifact in queue.results():
+            records.append(record)
+            if sheet_records is not None:
+                sheet_records.add(task_id, artifact if artifact is not None else record)
+        queue.close()
+        write_output_json(records, out_folder)
+        if sheet_records is not None:
+            write_spreadsheets(sheet_records, meta["config"]["fight_duration"], out_folder)
+    finally:
+        if sheet_records is not None:
+            sheet_records.close()
+
+
 def main(argv):
     parser = ArgumentParser()
-    parser.add_argument("-c", "--config", type=str, dest="config_filepath", required=True)
+    parser.add_argument("-c", "--config", type=str, dest="config_filepath")
     parser.add_argument("-g", "--graphs", action="store_true", dest="graphs")
     parser.add_argument("-s", "--spreadsheets", action="store_true", dest="spreadsheets")
-    parser.add_argument("-o", "--out_folder", dest="out_folder", default="./generated")
+    parser.add_argument("-o", "--out_folder", dest="out_folder", default=None)
     parser.add_argument("-j", "--n_jobs", dest="n_jobs", default=1, type=int)
     parser.add_argument("--gems", dest="gems", action="store_true")
+    parser.add_argument("--cache", dest="cache_folder", default=None)
+    parser.add_argument("--compact", dest="compact", action="store_true")
+    parser.add_argument("--jsonl", dest="jsonl", action="store_true")
+    queue_group = parser.add_mutually_exclusive_group()
+    queue_group.add_argument("--enqueue", dest="enqueue", default=None)
+    queue_group.add_argument("--work", dest="work", default=None)
+    queue_group.add_argument("--merge", dest="merge", default=None)
     parser.set_defaults(graphs=False, spreadsheet=False, gems=False)
     args, _ = parser.parse_known_args(argv)
+    if args.work is not None:
+        work_queue(args.work)
+        return
+    if args.merge is not None:
+        merge_queue(args.merge, args.out_folder)
+        return
+    if args.config_filepath is None:
+        parser.error("the following arguments are required: -c/--config")
+    if args.out_folder is None:
+        args.out_folder = "./generated"
 
     os.makedirs(args.out_folder, exist_ok=True)
 
     with open(args.config_filepath, "r", encoding="utf-8") as file:
         _in = json.load(file)
 
-    all_buffs = []
-    for buff in _in["buffs"]:
-        all_buffs.append((
-            StatsModifierArray([ALL_STATS_BUFFS[b] for b in buff["active"] if b in ALL_STATS_BUFFS], name=buff["name"]),
-            StatsModifierArray([ALL_SPELL_BUFFS[b] for b in buff["active"] if b in ALL_SPELL_BUFFS], name=buff["name"])
-        ))
-    all_talents = [DruidTalents(talent["points"], name=talent["name"]) for talent in _in["talents"]]
-    all_assignments = [Assignments.from_dict(rotation) for rotation in _in["rotations"]]
-
-    n_comb = len(_in["characters"]) * len(all_buffs) * len(all_talents) * len(all_assignments) * len(_in["gems_policy"])
+    if args.enqueue is not None:
+        fill_queue(args.enqueue, _in, args.out_folder, graphs=args.graphs, spreadsheets=args.spreadsheets,
+                   compact=args.compact)
+        return
 
-    combinations = Parallel(n_jobs=args.n_jobs)(
-        delayed(sim_loop)(i, n_comb, charac_info, buffs, talents, assignments, gems_policy, _in["fight_duration"], args.graphs, args.out_folder, args.gems)
-        for i, (charac_info, buffs, talents, assignments, gems_policy)
-        in enumerate(itertools.product(_in["characters"], all_buffs, all_talents, all_assignments, _in["gems_policy"])))
+    all_buffs, all_talents, all_assignments = build_axes(_in)
 
+    cells = list(expand_combinations(_in))
+    n_comb = len(cells)
     if args.spreadsheets:
-        write_spells_wb(FULL_DRUID, "spells", outfolder=args.out_folder)
-        write_compare_setups_wb(combinations, _in["fight_duration"], outfolder=args.out_folder)
+        warn_duplicate_labels(_in, cells)
+
+    cache = ResultCache(args.cache_folder) if args.cache_folder is not None else None
+    keys = [None] * n_comb
+    records = [None] * n_comb
+    if cache is not None:
+        for i, (c, b, t, a, g) in enumerate(cells):
+            # whole entries are hashed: their names label the output records
+            keys[i] = cache.key(character=_in["characters"][c], buffs=_in["buffs"][b],
+                                talents=_in["talents"][t], assignments=_in["rotations"][a],
+                                gems_policy=_in["gems_policy"][g], fight_duration=_in["fight_duration"],
+                                compact=args.compact)
+        # graphs need the simulated objects and spreadsheets compact records, cached records are only reused if
+        # they are enough
+        if not (args.graphs or (args.spreadsheets and not args.compact)):
+            records = [cache.get(key) for key in keys]
+    todo = [i for i, record in enumerate(records) if record is None]
+    if cache is not None:
+        print("{} cached combinations, {} to simulate".format(n_comb - len(todo), len(todo)))
+
+    all_gear = prepare_gear(_in["characters"], _in["gems_policy"],
+                            sorted({(cells[i][0], cells[i][4]) for i in todo}), plot_gems=args.gems)
+
+    tasks, costs = list(), list()
+    for i in todo:
+        c, b, t, a, g = cells[i]
+        tasks.append((i, (i, n_comb, _in["characters"][c], all_buffs[b], all_talents[t], all_assignments[a],
+                          _in["gems_policy"][g], all_gear[(c, g)], _in["fight_duration"], args.graphs, args.out_folder,
+                          args.compact)))
+        costs.append(estimate_cost(all_assignments[a], len(_in["characters"][c].get("on_use", [])), _in["fight_duration"]))
+    utilization = Utilization()
+    if args.n_jobs == 1:
+        # serial sweep, without the joblib import
+        results = (run_batch(sim_loop, batch) for batch in make_batches(tasks, costs, 1))
+    else:
+        from joblib import Parallel, delayed, effective_n_jobs
+        batches = make_batches(tasks, costs, effective_n_jobs(args.n_jobs))
+        results = Parallel(n_jobs=args.n_jobs, return_as="generator_unordered")(
+            delayed(run_batch)(sim_loop, batch) for batch in batches)
 
-    with open(os.path.join(args.out_folder, "output.json"), mode="w+", encoding="utf8") as file:
-        json.dump([{"character": c_name, "description": c_info, "stats": stats, "gems": gems,
-                    "spec": char.talents.name, "assignments": assignments.name}
-                   for c_name, c_info, char, assignments, _, stats, gems in combinations], file)
+    sheet_records = comparison_records(args.out_folder) if args.spreadsheets else None
+    if sheet_records is not None:
+        for i, record in enumerate(records):
+            if record is not None:
+                sheet_records.add(i, record)
 
+    stream = None
+    if args.jsonl:
+        stream = open(os.path.join(args.out_folder, "output.jsonl"), mode="w", encoding="utf8")
+        for i, record in enumerate(records):
+            if record is not None:
+                write_record(stream, record)
+                records[i] = None
 
+    try:
+        for worker, busy, batch_results in results:
+            utilization.add(worker, busy, len(batch_results))
+            for i, combination in batch_results:
+                if sheet_records is not None:
+                    sheet_records.add(i, sheet_record(combination, compact=args.compact))
+                record = combination_record(combination, compact=args.compact)
+                if cache is not None:
+                    cache.put(keys[i], record)
+                if stream is not None:
+                    write_record(stream, record)
+                else:
+                    records[i] = record
+        if len(todo) > 0:
+            print(utilization.report())
+        # results are written first, so that they are kept if the spreadsheets fail
+        if stream is None:
+            write_output_json(records, args.out_folder)
+        if sheet_records is not None:
+            write_spreadsheets(sheet_records, _in["fight_duration"], args.out_folder)
+    finally:
+        if stream is not None:
+            stream.close()
+        if sheet_records is not None:
+            sheet_records.close()
 
 
 if __name__ == "__main__":
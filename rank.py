@@ -3,17 +3,27 @@ from argparse import ArgumentParser
 from collections import defaultdict
 
 
+def read_records(filepath):
+    """combination records of a json output file, or of a json lines stream (read incrementally, the last line is
+    skipped if it is incomplete, i.e. still being written or cut by a killed run)"""
+    with open(filepath, "r", encoding="utf8") as file:
+        if not filepath.endswith(".jsonl"):
+            yield from json.load(file)
+            return
+        for line in file:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+
 def main(argv):
     parser = ArgumentParser()
     parser.add_argument("-f", "--filepath", type=str, dest="filepath", required=True)
     args, _ = parser.parse_known_args(argv)
 
-    with open(args.filepath, "r", encoding="utf8") as file:
-        data = json.load(file)
-
     rotations = defaultdict(list)
 
-    for comb in data:
+    for comb in read_records(args.filepath):
         phase = None
         character = comb["character"]
         if "phase" in character:
@@ -0,0 +1,79 @@
+import ast
+import hashlib
+import json
+import os
+import tempfile
+
+def simulation_modules(entry="main"):
+    """modules of this folder imported by `entry`, directly or through other modules of this folder (deferred
+    imports included): the code that produces simulation results"""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    modules, todo = set(), [entry]
+    while len(todo) > 0:
+        module = todo.pop()
+        if module in modules:
+            continue
+        modules.add(module)
+        with open(os.path.join(folder, module + ".py"), "rb") as file:
+            tree = ast.parse(file.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names = [node.module]
+            else:
+                continue
+            todo.extend(name.split(".")[0] for name in names
+                        if os.path.isfile(os.path.join(folder, name.split(".")[0] + ".py")))
+    return sorted(modules)
+
+
+def simulator_version():
+    """hash of the simulation sources, any code change invalidates the cached results"""
+    sha = hashlib.sha256()
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for module in simulation_modules():
+        sha.update(module.encode("utf8"))
+        with open(os.path.join(folder, module + ".py"), "rb") as file:
+            sha.update(file.read())
+    return sha.hexdigest()
+
+
+class ResultCache(object):
+    """Content-addressed cache of simulated combinations: one json file per combination, named after a stable hash
+    of the combination's configuration entries, the fight duration and the simulator version."""
+    def __init__(self, folder, version=None):
+        self._folder = folder
+        self._version = simulator_version() if version is None else version
+        os.makedirs(folder, exist_ok=True)
+
+    @property
+    def folder(self):
+        return self._folder
+
+    def key(self, **config):
+        """stable hash of json-serializable configuration entries"""
+        content = json.dumps({"version": self._version, **config}, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._folder, key + ".json")
+
+    def get(self, key):
+        """cached record, or None if missing or unreadable"""
+        try:
+            with open(self._path(key), "r", encoding="utf8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, record):
+        """write the record atomically, so that concurrent or interrupted runs never leave a partial entry"""
+        fd, tmp_path = tempfile.mkstemp(dir=self._folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as file:
+                json.dump(record, file)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
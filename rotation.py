@@ -1,9 +1,16 @@
+import heapq
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
 from buffs import Buff, ALL_STATS_BUFFS
-from character import Stats, BuffedCharacter
+from character import Stats
 from spell import HealingSpell, Lifebloom, HEALING_TOUCH, REJUVENATION, REGROWTH, LIFEBLOOM, TRANQUILITY
 from statsmodifiers import StatsModifierArray
 from talents import DruidTalents
-from util import bisect_right, sort_by, apply_crit, argmin
+from util import apply_crit, argmin
 
 
 def robust_zipstar(*arrays, tuple_size=2):
@@ -12,6 +19,67 @@ def robust_zipstar(*arrays, tuple_size=2):
     return zip(*arrays)
 
 
+class FormulaTokens(object):
+    """Formula tokens (e.g. '#lifebloom-1.hot_tick3#') referenced by id in heal and mana records. The tokens of the
+    known spells are registered at import in a fixed order, and no token is added afterwards: ids computed in a worker
+    process are resolved in the parent one, they must mean the same token in every process."""
+    def __init__(self, tokens=()):
+        self._tokens = list()
+        self._ids = dict()
+        for token in tokens:
+            if token not in self._ids:
+                self._ids[token] = len(self._tokens)
+                self._tokens.append(token)
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def __getitem__(self, token_id):
+        return self._tokens[token_id]
+
+    def id_of(self, token):
+        if token not in self._ids:
+            raise ValueError("formula token '{}' is not registered in FORMULA_TOKENS".format(token))
+        return self._ids[token]
+
+    def resolve(self, token_ids):
+        return [self._tokens[token_id] for token_id in token_ids]
+
+    @staticmethod
+    def spell_tokens(spell):
+        parts = ["avg_direct_heal", "hot_tick", "hot_tick1", "hot_tick2", "hot_tick3", "mana_cost"]
+        return ["#{}.{}#".format(spell.identifier, part) for part in parts]
+
+
+FORMULA_TOKENS = FormulaTokens([
+    token
+    for spells in [HEALING_TOUCH, REJUVENATION, REGROWTH, LIFEBLOOM, TRANQUILITY]
+    for spell in spells
+    for token in FormulaTokens.spell_tokens(spell)
+])
+
+
+def serializable_stats(stats):
+    """copy of rotation stats with numpy columns turned into lists and token ids resolved to formula strings"""
+    if isinstance(stats, dict):
+        out = dict()
+        for key, value in stats.items():
+            if key == "heal_tokens":
+                out["string_heals"] = FORMULA_TOKENS.resolve(value)
+            elif key == "mana_tokens":
+                out["string_mana"] = FORMULA_TOKENS.resolve(value)
+            else:
+                out[key] = serializable_stats(value)
+        return out
+    if isinstance(stats, np.ndarray):
+        return stats.tolist()
+    if isinstance(stats, (list, tuple)):
+        return [serializable_stats(v) for v in stats]
+    if isinstance(stats, np.generic):
+        return stats.item()
+    return stats
+
+
 class SingleAssignment(object):
     """single target and single spell assigment"""
     def __init__(self, spell, target, allow_fade=True, fade_at_stacks=1, spell_queue=False):
@@ -131,6 +199,13 @@ class Assignments(object):
             target_buffs=data.get("buffs")
         )
 
+    @property
+    def key(self):
+        """hashable description of what the scheduler reads from the assignments (names and buffs excluded)"""
+        def assignment_key(a):
+            return a.spell.identifier, a.target, a.allow_fade, a.fade_at_stacks, a.spell_queue
+        return tuple(assignment_key(a) for a in self._assignments), assignment_key(self._filler) if self.has_filler else None
+
     @property
     def spell_queued(self):
         """Returns assignments that have a spell-queue requirement (excluding filler)"""
@@ -194,10 +269,9 @@ class SpellEvent(Event):
     def _on_use_buffed_characters(cls, character, active_at_cast_on_use_events):
         # hot's capture the buffs when cast, ticks after the end of on use duration also benefit from the effect
         # -> no filtering
-        return BuffedCharacter(
-            character,
-            spell_buffs=StatsModifierArray([b for event in active_at_cast_on_use_events for b in event.item.spell_effects.buffs]),
-            stats_buffs=StatsModifierArray([b for event in active_at_cast_on_use_events for b in event.item.stats_effects.buffs]))
+        return character.buffed(
+            spell_modifiers=[b for event in active_at_cast_on_use_events for b in event.item.spell_effects.buffs],
+            stats_modifiers=[b for event in active_at_cast_on_use_events for b in event.item.stats_effects.buffs])
 
     @classmethod
     def _get_hot_first_tick_with_cadence(cls, start, period, cadence=None):
@@ -210,66 +284,60 @@ class SpellEvent(Event):
         return first
 
     def _hot_with_on_use(self, character, start, end, on_use=None, prev_tick_cadence=None):
+        if self.spell.type not in {HealingSpell.TYPE_HOT, HealingSpell.TYPE_HYBRID}:
+            raise ValueError("non hot spell cannot be applied on_use with hots")
         active_at_cast = self._on_use_active_at_cast(on_use=on_use)
+        table = character.spell_table(self.spell)
+        # buffs are captured at cast, all ticks have the same amount
+        tick = self._on_use_buffed_characters(character, active_at_cast).spell_table(self.spell).tick * self.stacks
         ticks = list()
-        max_ticks = self.spell.n_ticks(character)
-        period = self.spell.tick_period(character)
+        period = table.tick_period
         n_ticks = 0
         t = self._get_hot_first_tick_with_cadence(self.start, period, cadence=prev_tick_cadence)
-        while t <= end and t <= self.end and n_ticks < max_ticks:
+        while t <= end and t <= self.end and n_ticks < table.n_ticks:
             if t >= start:
-                character_at_tick = self._on_use_buffed_characters(character, active_at_cast)
-                if self.spell.type == HealingSpell.TYPE_HOT:
-                    tick = self.spell.get_healing(character_at_tick)
-                elif self.spell.type == HealingSpell.TYPE_HYBRID:
-                    _, tick = self.spell.get_healing(character_at_tick)
-                else:
-                    raise ValueError("non hot spell cannot be applied on_use with hots")
-                ticks.append((t, tick * self.stacks))
+                ticks.append((t, tick))
             t += period
             n_ticks += 1
 
         return ticks
 
     def _direct_with_on_use(self, character, on_use=None):
-        active_at_cast = self._on_use_active_at_cast(on_use=on_use)
-        character_at_tick = self._on_use_buffed_characters(character, active_at_cast)
-        if self.spell.type == HealingSpell.TYPE_DIRECT:
-            direct = self.spell.get_healing(character_at_tick)
-        elif self.spell.type == HealingSpell.TYPE_HYBRID:
-            direct, _ = self.spell.get_healing(character_at_tick)
-        else:
+        if self.spell.type not in {HealingSpell.TYPE_DIRECT, HealingSpell.TYPE_HYBRID}:
             raise ValueError("non hot spell cannot be applied on_use with hots")
-        return direct
+        active_at_cast = self._on_use_active_at_cast(on_use=on_use)
+        return self._on_use_buffed_characters(character, active_at_cast).spell_table(self.spell).direct
 
     def get_heals(self, start, end, character, on_use=None, prev_tick_cadence=None):
+        """(timestamps, heals, token ids) of the heals landing in [start, end], token ids index FORMULA_TOKENS"""
         # TODO spell duration and max_stacks are not applying any on use effects
-        timestamps, heals, string_heals = list(), list(), list()
+        table = character.spell_table(self.spell)
+        timestamps, heals, tokens = list(), list(), list()
         if self.spell.type == HealingSpell.TYPE_HOT:
-            tick_str = "#{spell}.hot_tick#".format(spell=self.spell.identifier)
+            tick_token = FORMULA_TOKENS.id_of("#{spell}.hot_tick#".format(spell=self.spell.identifier))
             t, h = robust_zipstar(*self._hot_with_on_use(character, start, end, on_use=on_use, prev_tick_cadence=prev_tick_cadence))
             timestamps.extend(t)
             heals.extend(h)
-            string_heals.extend([tick_str] * len(t))
+            tokens.extend([tick_token] * len(t))
         elif self.spell.type == HealingSpell.TYPE_DIRECT:
             timestamps.append(self.start)
             _avg = self._direct_with_on_use(character, on_use=on_use)
-            heals.append(apply_crit(_avg, character.get_stat(Stats.SPELL_CRIT)))
-            string_heals.append("#{spell}.avg_direct_heal#".format(spell=self.spell.identifier))
+            heals.append(apply_crit(_avg, table.spell_crit))
+            tokens.append(FORMULA_TOKENS.id_of("#{spell}.avg_direct_heal#".format(spell=self.spell.identifier)))
         elif self.spell.type == HealingSpell.TYPE_HYBRID:
-            if (self.spell.direct_first and self.start >= start) or (not self.spell.direct_first and start + self.spell.duration(character) <= end and self.spell.duration(character) <= self.duration):
+            if (self.spell.direct_first and self.start >= start) or (not self.spell.direct_first and start + table.duration <= end and table.duration <= self.duration):
                 timestamps.append(self.start if self.spell.direct_first else self.end)
                 direct_avg = self._direct_with_on_use(character, on_use=on_use)
-                with_crit = apply_crit(direct_avg, character.get_stat(Stats.SPELL_CRIT))
+                with_crit = apply_crit(direct_avg, table.spell_crit)
                 heals.append(direct_avg if isinstance(self.spell, Lifebloom) else with_crit)
-                string_heals.append("#{spell}.avg_direct_heal#".format(spell=self.spell.identifier))
-            tick_str = "#{spell}.hot_tick{tick}#".format(spell=self.spell.identifier, tick="" if self.spell.max_stacks(character) == 1 else self.stacks)
+                tokens.append(FORMULA_TOKENS.id_of("#{spell}.avg_direct_heal#".format(spell=self.spell.identifier)))
+            tick_token = FORMULA_TOKENS.id_of("#{spell}.hot_tick{tick}#".format(spell=self.spell.identifier, tick="" if table.max_stacks == 1 else self.stacks))
             t, h = robust_zipstar(*self._hot_with_on_use(character, start, end, on_use=on_use, prev_tick_cadence=prev_tick_cadence))
             timestamps.extend(t)
             heals.extend(h)
-            string_heals.extend([tick_str] * len(t))
+            tokens.extend([tick_token] * len(t))
 
-        tuple_array = [(t, h, s) for t, h, s in zip(timestamps, heals, string_heals) if start <= t <= end]
+        tuple_array = [(t, h, s) for t, h, s in zip(timestamps, heals, tokens) if start <= t <= end]
         if len(tuple_array) == 0:
             return [], [], []
         return tuple(zip(*tuple_array))
@@ -294,136 +362,195 @@ class OnUseEvent(Event):
 
 
 class Timeline(object):
+    """Events are stored column-wise (start, duration, stacks, kind and interned spell/item id) so that searches run
+    on a plain array of starts. Event objects are only built when accessed."""
+    _KIND_BUSY = 0
+    _KIND_SPELL = 1
+    _KIND_ON_USE = 2
+
     def __init__(self, name):
         self._name = name
-        self._events = list()
+        self._starts = array("d")
+        self._durations = array("d")
+        self._stacks = array("i")
+        self._kinds = array("b")
+        self._payload_ids = array("i")
+        self._payloads = list()  # interned spells and items
 
     def __repr__(self):
         return "Timeline<{}>()".format(self._name)
 
     def __len__(self):
-        return len(self._events)
+        return len(self._starts)
 
     def __iter__(self):
-        return iter(self._events)
+        return (self._event(i) for i in range(len(self)))
 
     def __getitem__(self, item):
-        return self._events[item]
+        if isinstance(item, slice):
+            return [self._event(i) for i in range(len(self))[item]]
+        return self._event(range(len(self))[item])
+
+    def _event(self, index):
+        kind, start, duration = self._kinds[index], self._starts[index], self._durations[index]
+        payload = self._payloads[self._payload_ids[index]]
+        if kind == Timeline._KIND_SPELL:
+            event = SpellEvent(start, payload, stacks=self._stacks[index])
+            event.duration = duration
+            return event
+        elif kind == Timeline._KIND_ON_USE:
+            return OnUseEvent(start, duration, payload)
+        else:
+            return BusyEvent(start, duration)
+
+    def _append(self, kind, start, duration, stacks=1, payload=None):
+        for payload_id, interned in enumerate(self._payloads):
+            if interned is payload:
+                break
+        else:
+            payload_id = len(self._payloads)
+            self._payloads.append(payload)
+        self._starts.append(start)
+        self._durations.append(duration)
+        self._stacks.append(stacks)
+        self._kinds.append(kind)
+        self._payload_ids.append(payload_id)
 
     def add_spell_event(self, start, spell):
-        event = SpellEvent.from_spell(spell, start)
+        stacks = 1
         if len(self) > 0:  # any spell in the pipeline
-            prev_event = self._events[-1]
-            if prev_event.spell.identifier != spell.identifier:
+            prev_spell = self._payloads[self._payload_ids[-1]]
+            if self._kinds[-1] != Timeline._KIND_SPELL or prev_spell.identifier != spell.identifier:
                 raise ValueError("cannot store different spells in a timeline")
-            if prev_event.end > start:
-                prev_event.duration -= (prev_event.end - start)
-                event.stacks = min(prev_event.stacks + 1, spell.base_max_stacks)
-        self._events.append(event)
+            prev_end = self._starts[-1] + self._durations[-1]
+            if prev_end > start:
+                self._durations[-1] -= (prev_end - start)
+                stacks = min(self._stacks[-1] + 1, spell.base_max_stacks)
+        self._append(Timeline._KIND_SPELL, start, spell.base_duration, stacks=stacks, payload=spell)
 
     def add_busy_event(self, start, duration):
-        self._events.append(BusyEvent(start, duration=duration))
+        self._append(Timeline._KIND_BUSY, start, duration)
 
     def add_on_use_event(self, event: OnUseEvent):
-        self._events.append(event)
+        self._append(Timeline._KIND_ON_USE, event.start, event.duration, payload=event.item)
 
     @property
     def duration(self):
-        if len(self._events) == 0:
+        if len(self) == 0:
             return 0
         else:
-            return self._events[-1].end - self._events[0].start
+            return self.end - self._starts[0]
 
     @property
     def start(self):
-        return self._events[0].start if len(self) > 0 else 0
+        return self._starts[0] if len(self) > 0 else 0
 
     @property
     def end(self):
-        return self._events[-1].end if len(self) > 0 else 0
+        return self._starts[-1] + self._durations[-1] if len(self) > 0 else 0
 
     def _index_event_before(self, at):
-        return bisect_right(self._events, at, key=lambda event: event.start)
+        return bisect_right(self._starts, at)
 
-    def event_at(self, at):
+    def _index_event_at(self, at):
         index = self._index_event_before(at)
         if index == 0:
             return None
-        event = self._events[index - 1]
-        return event if (event.start <= at <= event.end) else None
+        index -= 1
+        start = self._starts[index]
+        return index if start <= at <= start + self._durations[index] else None
+
+    def event_at(self, at):
+        index = self._index_event_at(at)
+        return None if index is None else self._event(index)
 
     def event_before(self, at):
         index = self._index_event_before(at)
         if index == 0:
             return None
-        event = self._events[index - 1]
-        return event if event.start <= at else None
+        return self._event(index - 1) if self._starts[index - 1] <= at else None
 
     def events_starting_after(self, at, n=-1):
         index = self._index_event_before(at)
-        while index < len(self) and self._events[index].start < at:
+        while index < len(self) and self._starts[index] < at:
             index += 1
         if n == -1:
-            return self._events[index:]
+            return self[index:]
         else:
-            return self._events[index:index + n]
+            return self[index:index + n]
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def starts(self):
+        return self._starts
+
+    @property
+    def durations(self):
+        return self._durations
+
+    @property
+    def stacks(self):
+        return self._stacks
+
     def uptime(self, start=0, end=None):
+        """events of a timeline never overlap, so only the events around start and end can be clipped"""
         if end is None:
             end = self.end
-        events = [e for e in self._events if start <= e.start <= end or start <= e.end <= end]
-        uptime = sum([e.duration for e in self._events], 0)
-        if len(events) > 0 and events[0].start < start:
-            uptime -= start - events[0].start
-        if len(events) > 0 and end is not None and events[-1].end > end:
-            uptime -= events[-1].end - end
+        # first/last events starting or ending in [start, end]
+        lo, hi = bisect_left(self._starts, start), bisect_right(self._starts, end)
+        first, last = (lo, hi - 1) if lo < hi else (None, None)
+        if lo > 0 and start <= self._starts[lo - 1] + self._durations[lo - 1] <= end:
+            first = lo - 1
+            last = first if last is None else last
+        uptime = sum(self._durations, 0)
+        if first is not None and self._starts[first] < start:
+            uptime -= start - self._starts[first]
+        if last is not None and self._starts[last] + self._durations[last] > end:
+            uptime -= self._starts[last] + self._durations[last] - end
         return uptime
 
     def is_up_at(self, at):
-        event = self.event_at(at)
-        return event is not None
+        return self._index_event_at(at) is not None
 
     def remaining_uptime(self, at):
-        event = self.event_at(at)
-        return (event.end - at) if event is not None else 0
+        index = self._index_event_at(at)
+        return (self._starts[index] + self._durations[index] - at) if index is not None else 0
 
     def total_time(self):
         """time between 0 and last self end's time"""
-        if len(self) == 0:
-            return 0
-        else:
-            return self._events[-1].end
+        return self.end
 
     def stats(self, character, start=0, end=None, on_use=None):
         if end is None:
-            end = start if len(self) == 0 else self._events[-1].end
-        filtered = [e for e in self._events
-                    if isinstance(e, SpellEvent) and (start <= e.start <= end or start <= e.end <= end)]
+            end = start if len(self) == 0 else self.end
+        filtered = [self._event(i) for i, (e_start, e_duration, kind) in enumerate(zip(self._starts, self._durations, self._kinds))
+                    if kind == Timeline._KIND_SPELL and (start <= e_start <= end or start <= e_start + e_duration <= end)]
 
-        timestamps = list()
-        heals = list()
-        string_heals = list()
+        timestamps, heals, heal_tokens = list(), list(), list()
 
         prev_tick_cadence = None
         for event in filtered:
             if isinstance(event, SpellEvent) and event.spell.name == "lifebloom" and (prev_tick_cadence is None or event.stacks == 1):
                 prev_tick_cadence = event.start
             t, h, s = event.get_heals(start, end, character, on_use=on_use, prev_tick_cadence=prev_tick_cadence)
-            if isinstance(event, SpellEvent) and event.spell.name == "lifebloom" and len(t) == event.spell.n_ticks(character):
+            if isinstance(event, SpellEvent) and event.spell.name == "lifebloom" and len(t) == character.spell_table(event.spell).n_ticks:
                 # does tick reset ? seven ticks = reset
                 prev_tick_cadence = None
             timestamps.extend(t)
             heals.extend(h)
-            string_heals.extend(s)
+            heal_tokens.extend(s)
 
-        timestamps, heals, string_heals = sort_by(timestamps, heals, string_heals, f=(lambda t, h, s: start <= t <= end))
-        mana_ticks = [e.start for e in filtered]
-        mana_costs = [e.spell.mana_cost(character) for e in filtered]
-        string_mana = ["#{spell}.mana_cost#".format(spell=e.spell.identifier) for e in filtered]
+        timestamps = np.array(timestamps, dtype=float)
+        order = np.argsort(timestamps, kind="stable")
+        heals = np.array(heals, dtype=float)[order]
+        heal_tokens = np.array(heal_tokens, dtype=np.int32)[order]
+        timestamps = timestamps[order]
+        mana_ticks = np.array([e.start for e in filtered], dtype=float)
+        mana_costs = np.array([character.spell_table(e.spell).mana_cost for e in filtered], dtype=float)
+        mana_tokens = np.array([FORMULA_TOKENS.id_of("#{spell}.mana_cost#".format(spell=e.spell.identifier)) for e in filtered], dtype=np.int32)
 
         return {
             "uptime": self.uptime(start=start, end=end),
@@ -432,15 +559,58 @@ class Timeline(object):
             "duration": end - start,
             "mana_costs": mana_costs,
             "mana_ticks": mana_ticks,
-            "string_mana": string_mana,
-            "total_mana": sum(mana_costs),
+            "mana_tokens": mana_tokens,
+            "total_mana": float(mana_costs.sum()),
             "heals": heals,
-            "string_heals": string_heals,
+            "heal_tokens": heal_tokens,
             "timestamps": timestamps,
-            "total_heal": sum(heals)
+            "total_heal": float(heals.sum())
         }
 
 
+class RegenLedger(object):
+    """Mana regen ticks (every 2 seconds) of a rotation whose casts are known. Ticks are classified in/out of the
+    five-second rule by a single merge-sweep over ticks and casts, then any window is answered by slicing and prefix
+    counts."""
+    TICK_PERIOD = 2
+
+    def __init__(self, cast_timeline, in_5sr, out_5sr):
+        self._cast_timeline = cast_timeline
+        self._in_5sr = in_5sr
+        self._out_5sr = out_5sr
+        self._mana = list()  # mana gained at the i-th tick (time 2 * i)
+        self._n_out = [0]  # number of out of 5SR ticks before the i-th tick
+        self._cast_index = 0  # number of casts started before the last swept tick
+
+    def _extend(self, n_ticks):
+        starts, durations = self._cast_timeline.starts, self._cast_timeline.durations
+        while len(self._mana) < n_ticks:
+            t = len(self._mana) * RegenLedger.TICK_PERIOD
+            while self._cast_index < len(starts) and starts[self._cast_index] <= t:
+                self._cast_index += 1
+            before = self._cast_index - 1
+            out = before < 0 or t - (starts[before] + durations[before]) > 5
+            self._mana.append(self._out_5sr if out else self._in_5sr)
+            self._n_out.append(self._n_out[-1] + (1 if out else 0))
+
+    def _window(self, start, end):
+        first = int((start - (start % RegenLedger.TICK_PERIOD)) // RegenLedger.TICK_PERIOD)
+        last = max(first, math.ceil(end / RegenLedger.TICK_PERIOD))
+        self._extend(last)
+        return first, last
+
+    def ticks(self, start, end):
+        """(tick times, mana gained) for ticks in [start - start % 2, end)"""
+        first, last = self._window(start, end)
+        return [i * RegenLedger.TICK_PERIOD for i in range(first, last)], self._mana[first:last]
+
+    def total(self, start, end):
+        """mana gained over the ticks in [start - start % 2, end)"""
+        first, last = self._window(start, end)
+        n_out = self._n_out[last] - self._n_out[first]
+        return n_out * self._out_5sr + (last - first - n_out) * self._in_5sr
+
+
 def remove_prefix(text, prefix):
     if text.startswith(prefix):
         return text[len(prefix):]
@@ -448,6 +618,19 @@ def remove_prefix(text, prefix):
 
 
 class Rotation(object):
+    SCHEDULER_EVENT = "event"
+    SCHEDULER_STEP = "step"
+
+    # regen ticks and spell expiries are processed before decisions scheduled at the same time
+    _EVENT_REGEN_TICK = 0
+    _EVENT_EXPIRY = 1
+    _EVENT_DECISION = 2
+
+    # simulated schedules by timing fingerprint, shared by rotations of the same process. The least recently used
+    # schedule is dropped once MAX_SCHEDULES are kept
+    MAX_SCHEDULES = 256
+    _schedules = dict()
+
     def __init__(self, assignments):
         self._assignments = assignments
         self._reset_state()
@@ -459,6 +642,9 @@ class Rotation(object):
         self._uptime_timeline = Timeline("uptime")
         self._filler_target_suffixes = list()
         self._rotation_assigments = list()
+        self._regen_ledger = None
+        self._regen_ledger_character = None
+        self._live_spells = None  # (start, end, stacks) of the latest spell by timeline, kept by the event scheduler
 
     def _get_regen_per_tick(self, character):
         mp5 = character.get_stat(Stats.MP5)
@@ -467,33 +653,140 @@ class Rotation(object):
         out_5sr = 2 * (mp5 + regen) / 5
         return in_5sr, out_5sr
 
-    def optimal_rotation(self, character, fight_duration=120, reaction=0.01, eps=1e-6, opt_for_ticks=False):
+    def optimal_rotation(self, character, fight_duration=120, reaction=0.01, eps=1e-6, opt_for_ticks=False, scheduler=None,
+                         reuse=True):
+        """Simulate the rotation. With the (default) event scheduler, decisions, spell expiries and regen ticks are
+        popped from a priority queue and time jumps straight to the next one. The step scheduler polls actions and regen
+        after every step. Both make the same casts and count each regen tick once.
+
+        With reuse, the timelines of a previous simulation with the same assignments and timing fingerprint (see
+        _schedule_fingerprint) are taken instead of simulating again. Scheduled timelines are never modified
+        afterwards, so they are shared and not copied. At most MAX_SCHEDULES schedules are kept."""
+        scheduler = Rotation.SCHEDULER_EVENT if scheduler is None else scheduler
+        if scheduler not in {Rotation.SCHEDULER_EVENT, Rotation.SCHEDULER_STEP}:
+            raise ValueError("unknown scheduler '{}'".format(scheduler))
+        key = None
+        if reuse:
+            key = self._schedule_fingerprint(character, fight_duration, reaction, eps, opt_for_ticks, scheduler)
+            if key in Rotation._schedules:
+                state = Rotation._schedules.pop(key)
+                Rotation._schedules[key] = state
+                self._restore_schedule(state)
+                return
+        if scheduler == Rotation.SCHEDULER_EVENT:
+            self._event_driven_rotation(character, fight_duration, reaction=reaction, eps=eps, opt_for_ticks=opt_for_ticks)
+        else:
+            self._stepping_rotation(character, fight_duration, reaction=reaction, eps=eps, opt_for_ticks=opt_for_ticks)
+        if reuse:
+            if len(Rotation._schedules) >= Rotation.MAX_SCHEDULES:
+                del Rotation._schedules[next(iter(Rotation._schedules))]
+            Rotation._schedules[key] = self._schedule_state()
+
+    def _schedule_fingerprint(self, character, fight_duration, reaction, eps, opt_for_ticks, scheduler):
+        """everything the scheduler reads from the character: gcd, cast times, durations, tick periods and max stacks
+        of the assigned spells, plus mana and regen when simulating until OOM"""
+        spells = [a.spell for a in self._assignments]
+        if self._assignments.has_filler:
+            spells.append(self._assignments.filler.spell)
+        tables = [character.spell_table(spell) for spell in spells]
+        timings = tuple(
+            (table.spell.identifier, table.cast_time, table.duration, table.tick_period, table.max_stacks)
+            for table in tables
+        )
+        mana = None
+        if fight_duration < 0:
+            mana = (character.get_stat(Stats.MANA), self._get_regen_per_tick(character),
+                    tuple(table.mana_cost for table in tables))
+        return (self._assignments.key, fight_duration, reaction, eps, opt_for_ticks, scheduler,
+                character.get_stat(Stats.GCD), timings, mana)
+
+    def _schedule_state(self):
+        return (dict(self._timelines), self._gcd_timeline, self._cast_timeline, self._uptime_timeline,
+                list(self._filler_target_suffixes))
+
+    def _restore_schedule(self, state):
+        self._reset_state()
+        timelines, self._gcd_timeline, self._cast_timeline, self._uptime_timeline, filler_target_suffixes = state
+        self._timelines = dict(timelines)
+        self._filler_target_suffixes = list(filler_target_suffixes)
+
+    @classmethod
+    def clear_schedules(cls):
+        cls._schedules.clear()
+
+    def _cast(self, start_time, gcd, assignment, character):
+        """register the cast of an assignment, returns the cast time"""
+        cast_time = character.spell_table(assignment.spell).cast_time
+        self._gcd_timeline.add_busy_event(start_time, gcd)
+        self._cast_timeline.add_busy_event(start_time, cast_time)
+        self._uptime_timeline.add_busy_event(start_time, max(gcd, cast_time))
+        self._timelines[assignment.identifier].add_spell_event(start_time + cast_time, assignment.spell)
+        self._rotation_assigments.append(assignment)
+        return cast_time
+
+    def _stepping_rotation(self, character, fight_duration=120, reaction=0.01, eps=1e-6, opt_for_ticks=False):
         self._reset_state()
         gcd = character.get_stat(Stats.GCD)
         current_time = 0
         mana = character.get_stat(Stats.MANA)
-        last_mana_tick = 2
+        last_mana_tick = 0  # no tick at time 0
         while (fight_duration < 0 and mana > 0) or current_time < fight_duration:
             wait, assignment = self._action_at(current_time + eps, gcd, character, reaction=reaction, opt_for_ticks=opt_for_ticks)
             if wait < 0:
-                start_time = current_time + eps
-                cast_time = assignment.spell.cast_time(character)
-                self._gcd_timeline.add_busy_event(start_time, gcd)
-                self._cast_timeline.add_busy_event(start_time, cast_time)
-                self._uptime_timeline.add_busy_event(start_time, max(gcd, cast_time))
-                self._timelines[assignment.identifier].add_spell_event(start_time + cast_time, assignment.spell)
-                self._rotation_assigments.append(assignment)
+                cast_time = self._cast(current_time + eps, gcd, assignment, character)
                 current_time += max(gcd, cast_time) + eps
-                mana -= assignment.spell.mana_cost(character)
+                mana -= character.spell_table(assignment.spell).mana_cost
             else:
                 current_time += wait
 
-            # evaluate regen
-            ticks, mana_gained = self._regen_ticks(character, start=last_mana_tick, end=current_time + eps)
+            # evaluate regen ticks since the last one
+            ticks, mana_gained = self._regen_ticks(character, start=last_mana_tick + 2, end=current_time + eps)
             if len(ticks) > 0:
                 last_mana_tick = ticks[-1]
                 mana += sum(mana_gained)
 
+    def _event_driven_rotation(self, character, fight_duration=120, reaction=0.01, eps=1e-6, opt_for_ticks=False):
+        self._reset_state()
+        self._live_spells = dict()
+        gcd = character.get_stat(Stats.GCD)
+        mana = character.get_stat(Stats.MANA)
+        queue = [(0, Rotation._EVENT_DECISION)]
+        # mana is only needed to stop run-to-OOM simulations
+        track_mana = fight_duration < 0
+        if track_mana:
+            in_5sr, out_5sr = self._get_regen_per_tick(character)
+            last_cast_end = None
+            heapq.heappush(queue, (2, Rotation._EVENT_REGEN_TICK))
+
+        while len(queue) > 0:
+            event = heapq.heappop(queue)
+            current_time, event_type = event[0], event[1]
+            if event_type == Rotation._EVENT_REGEN_TICK:
+                mana += out_5sr if last_cast_end is None or current_time - last_cast_end > 5 else in_5sr
+                heapq.heappush(queue, (current_time + 2, Rotation._EVENT_REGEN_TICK))
+                continue
+            if event_type == Rotation._EVENT_EXPIRY:
+                # a refreshed spell leaves its previous deadline behind
+                identifier = event[2]
+                if self._live_spells[identifier][1] == current_time:
+                    del self._live_spells[identifier]
+                continue
+
+            if not ((track_mana and mana > 0) or current_time < fight_duration):
+                break
+            wait, assignment = self._action_at(current_time + eps, gcd, character, reaction=reaction, opt_for_ticks=opt_for_ticks)
+            if wait < 0:
+                cast_time = self._cast(current_time + eps, gcd, assignment, character)
+                timeline = self._timelines[assignment.identifier]
+                self._live_spells[assignment.identifier] = (timeline.starts[-1], timeline.end, timeline.stacks[-1])
+                heapq.heappush(queue, (timeline.end, Rotation._EVENT_EXPIRY, assignment.identifier))
+                heapq.heappush(queue, (current_time + (max(gcd, cast_time) + eps), Rotation._EVENT_DECISION))
+                if track_mana:
+                    mana -= character.spell_table(assignment.spell).mana_cost
+                    last_cast_end = current_time + eps + cast_time
+            else:
+                heapq.heappush(queue, (current_time + wait, Rotation._EVENT_DECISION))
+
     @property
     def duration(self):
         return self.end - self.start
@@ -533,27 +826,50 @@ class Rotation(object):
     def assignments(self):
         return self._assignments
 
+    def _active_spell(self, identifier, at):
+        """(end, stacks) of the spell event of the assignment timeline active at `at`, None if not up. With the event
+        scheduler, the latest spell of each timeline is kept until its expiry is popped from the queue. Otherwise it
+        is read from the timeline columns: spell events land before the next decision, so the latest event is checked
+        first"""
+        if self._live_spells is not None:
+            live = self._live_spells.get(identifier)
+            if live is None:
+                return None
+            start, end, stacks = live
+            # expiries between the decision time and `at` are still in the queue
+            if start <= at:
+                return (end, stacks) if at <= end else None
+        timeline = self._timelines[identifier]
+        starts, durations = timeline.starts, timeline.durations
+        index = len(starts) - 1
+        if index >= 0 and starts[index] > at:
+            index = bisect_right(starts, at) - 1
+        if index < 0:
+            return None
+        end = starts[index] + durations[index]
+        return (end, timeline.stacks[index]) if at <= end else None
+
     def _action_at(self, current_time, gcd, character, reaction=0.01, opt_for_ticks=False):
         """(wait_duration|-1, assigment|None)"""
         lookahead = 9999  # to store the time before a higher priority hot must be reapplied
         wait = 9999
         for assignment in self._assignments:
             # current cast time/gcd prevent from later applying/casting a higher priority spell
-            cast_time = assignment.spell.cast_time(character)
+            cast_time = character.spell_table(assignment.spell).cast_time
             if max(gcd, cast_time) >= lookahead:
                 continue
 
             # current spell not up, so cast !
-            timeline = self._timelines[assignment.identifier]
-            if not timeline.is_up_at(current_time):
+            active = self._active_spell(assignment.identifier, current_time)
+            if active is None:
                 return -1, assignment
 
             # spell is up (can only be a HoT), cast time does not prevent higher priority spell to be
             # cast in the future
-            spell_event = timeline.event_at(current_time)
-            remaining_time = timeline.remaining_uptime(current_time)
+            end, stacks = active
+            remaining_time = end - current_time
             period = assignment.spell.base_tick_period
-            if assignment.allow_fade and spell_event.stacks == assignment.fade_at_stacks:
+            if assignment.allow_fade and stacks == assignment.fade_at_stacks:
                 # cast right after last tick (t_cast + duration - period + reaction), or wait so that casting time
                 # results in landing the heal right after the last tick
                 if cast_time > remaining_time:
@@ -573,9 +889,9 @@ class Rotation(object):
             min_assign, min_time = None, 0
             for assignment in spell_queued:
                 timeline = self._timelines[assignment.identifier]
-                if len(timeline) == 0 or timeline[-1].end < current_time:
+                if len(timeline) == 0 or timeline.end < current_time:
                     continue
-                remaining = timeline[-1].end - current_time
+                remaining = timeline.end - current_time
                 if min_assign is None or min_time > remaining:
                     min_time = remaining
                     min_assign = assignment
@@ -592,14 +908,14 @@ class Rotation(object):
             return wait, None
 
         filler = self._assignments.filler
-        cast_time = filler.spell.cast_time(character)
+        cast_time = character.spell_table(filler.spell).cast_time
         downtime = max(character.get_stat(Stats.GCD), cast_time)
         if downtime > lookahead:
             return wait, None
 
         for target_suffix in self._filler_target_suffixes:
             filler_assignment = FillerAssignment(filler, target_suffix)
-            if self._timelines[filler_assignment.identifier].is_up_at(current_time + reaction):
+            if self._active_spell(filler_assignment.identifier, current_time + reaction) is not None:
                 continue
             return -1, filler_assignment
 
@@ -616,18 +932,19 @@ class Rotation(object):
         stats["timelines"] = dict()
         stats["targets"] = dict()
 
-        targets = {t[1] for t in self._timelines}
-
         id2assign = {a.identifier: a for a in self._assignments}
         for identifier, timeline in self._timelines.items():
             if identifier not in id2assign:
                 comp_character = character
             else:
-                comp_character = BuffedCharacter(character, stats_buffs=self._assignments.buffs(id2assign[identifier].target))
+                comp_character = character.buffed(stats_modifiers=self._assignments.buffs(id2assign[identifier].target).buffs)
             stats["timelines"][timeline.name] = timeline.stats(comp_character, start=start, end=end, on_use=on_use)
             self._per_unit_stats(stats["timelines"][timeline.name], character)
 
-        stats.update(**self._merge_timeline_stats(*stats["timelines"].values()))
+        name2target = {timeline.name: tl_target for (_, tl_target), timeline in self._timelines.items()}
+        merged, per_target = self._merge_timeline_stats(list(stats["timelines"].values()),
+                                                        [name2target[name] for name in stats["timelines"]])
+        stats.update(**merged)
         self._per_unit_stats(stats, character, start=start, end=end)
         stats["uptime"] = self._uptime_timeline.uptime(start=start, end=end)
         stats["gcd"] = {
@@ -635,11 +952,8 @@ class Rotation(object):
             "wasted": len(self._wasted_gcd(character, start=start, end=end))
         }
 
-        for target in targets:
-            target_timelines = [stats["timelines"][t.name]
-                                for (_, tl_target), t in self._timelines.items()
-                                if tl_target == target]
-            stats["targets"][target] = self._merge_timeline_stats(*target_timelines)
+        for target, target_stats in per_target.items():
+            stats["targets"][target] = target_stats
             self._per_unit_stats(stats["targets"][target], character)
 
         return stats
@@ -660,13 +974,24 @@ class Rotation(object):
             t += 2
         return ticks, mana
 
+    def _get_regen_ledger(self, character):
+        """regen ledger of the simulated rotation, built once per character"""
+        if self._regen_ledger is None or self._regen_ledger_character is not character:
+            in_5sr, out_5sr = self._get_regen_per_tick(character)
+            self._regen_ledger = RegenLedger(self._cast_timeline, in_5sr, out_5sr)
+            self._regen_ledger_character = character
+        return self._regen_ledger
+
     def _per_unit_stats(self, stats, character, start=0, end=None):
+        if end is None:
+            end = self.end
         duration = stats["duration"]
         stats["hps"] = stats["total_heal"] / duration
         stats["mps"] = stats["total_mana"] / duration
         stats["hpm"] = stats["total_heal"] / stats["total_mana"] if stats["total_mana"] else 0
-        stats["mana_regen_ticks"], stats["mana_regen_gained"] = self._regen_ticks(character, start=start, end=end)
-        stats["time2oom"] = character.get_stat(Stats.MANA) / ((sum(stats["mana_costs"]) / duration) - (sum(stats["mana_regen_gained"]) / duration))
+        ledger = self._get_regen_ledger(character)
+        stats["mana_regen_ticks"], stats["mana_regen_gained"] = ledger.ticks(start, end)
+        stats["time2oom"] = character.get_stat(Stats.MANA) / ((stats["total_mana"] / duration) - (ledger.total(start, end) / duration))
 
     def _wasted_gcd(self, character, start=0, end=None):
         if end is None:
@@ -694,36 +1019,45 @@ class Rotation(object):
         return wasted_gcds
 
     @classmethod
-    def _merge_timeline_stats(cls, *timeline_stats):
-        stats = dict()
-        stats["start"] = min([t["start"] for t in timeline_stats])
-        stats["end"] = min([t["end"] for t in timeline_stats])
-        stats["duration"] = stats["end"] - stats["start"]
-
-        mana_ticks, mana_costs, heals, timestamps, string_heals, string_mana = [list() for _ in range(6)]
-
-        for timeline_stat in timeline_stats:
-            mana_ticks.extend(timeline_stat["mana_ticks"])
-            mana_costs.extend(timeline_stat["mana_costs"])
-            heals.extend(timeline_stat["heals"])
-            string_heals.extend(timeline_stat["string_heals"])
-            string_mana.extend(timeline_stat["string_mana"])
-            timestamps.extend(timeline_stat["timestamps"])
-
-        mana_ticks, mana_costs, string_mana = sort_by(mana_ticks, mana_costs, string_mana)
-        timestamps, heals, string_heals = sort_by(timestamps, heals, string_heals)
-        stats.update(**{
-            "mana_ticks": mana_ticks,
-            "mana_costs": mana_costs,
-            "string_mana": string_mana,
-            "mana": sum(mana_costs),
-            "heals": heals,
-            "string_heals": string_heals,
-            "timestamps": timestamps,
-            "total_mana": sum(mana_costs),
-            "total_heal": sum(heals)
-        })
-        return stats
+    def _merge_timeline_stats(cls, timeline_stats, groups):
+        """merge the time ordered heal and mana columns of timeline_stats with one stable argsort per column, returns
+        the merged view of all timelines and a merged view per group (groups[i] is the group of timeline_stats[i])"""
+        heal_columns = ("timestamps", "heals", "heal_tokens")
+        mana_columns = ("mana_ticks", "mana_costs", "mana_tokens")
+        group_ids = dict()
+        for group in groups:
+            group_ids.setdefault(group, len(group_ids))
+
+        def merged(columns):
+            lengths = [len(t[columns[0]]) for t in timeline_stats]
+            merged_columns = [np.concatenate([t[column] for t in timeline_stats]) for column in columns]
+            owners = np.repeat(np.array([group_ids[group] for group in groups], dtype=np.int32), lengths)
+            # stable: ties keep timeline order, so masking a group gives the same order as merging it alone
+            order = np.argsort(merged_columns[0], kind="stable")
+            return [column[order] for column in merged_columns], owners[order]
+
+        heal_merged, heal_owners = merged(heal_columns)
+        mana_merged, mana_owners = merged(mana_columns)
+
+        def view(selected, heal_mask=None, mana_mask=None):
+            stats = dict()
+            stats["start"] = min([t["start"] for t in selected])
+            stats["end"] = min([t["end"] for t in selected])
+            stats["duration"] = stats["end"] - stats["start"]
+            for column, values in zip(heal_columns, heal_merged):
+                stats[column] = values if heal_mask is None else values[heal_mask]
+            for column, values in zip(mana_columns, mana_merged):
+                stats[column] = values if mana_mask is None else values[mana_mask]
+            stats["total_mana"] = float(stats["mana_costs"].sum())
+            stats["mana"] = stats["total_mana"]
+            stats["total_heal"] = float(stats["heals"].sum())
+            return stats
+
+        group_stats = dict()
+        for group, group_id in group_ids.items():
+            selected = [t for t, g in zip(timeline_stats, groups) if g == group]
+            group_stats[group] = view(selected, heal_mask=heal_owners == group_id, mana_mask=mana_owners == group_id)
+        return view(timeline_stats), group_stats
 
 
 def make_on_use_timelines(duration, items, cast_timeline):
@@ -1,15 +1,41 @@
 from abc import abstractmethod
 
-from character import FULL_DRUID
+import numpy as np
+
 from heal_parts import HealParts
-from items import ALL_ITEMS_GEAR
 from statistics import Stats
 from talents import DruidTalents
+from util import apply_crit
 
 HEAL_GENERIC_FORMULA = "(({base} + {coef} * {bh}) * {gift})"
 HOT_GENERIC_FORMULA = "({} / {{ticks}})".format(HEAL_GENERIC_FORMULA)
 
 
+class FormulaTemplates(object):
+    """Excel formulas of the spells (strings with #Group.key# references), rendered on first use and kept for the
+    process: they only depend on the spell and FULL_DRUID, which never changes"""
+    def __init__(self):
+        self._templates = dict()
+
+    @staticmethod
+    def context_key(context):
+        return tuple(sorted(context.items()))
+
+    def get(self, key, render, *args, **kwargs):
+        if key not in self._templates:
+            self._templates[key] = render(*args, **kwargs)
+        return self._templates[key]
+
+    def clear(self):
+        self._templates.clear()
+
+    def __len__(self):
+        return len(self._templates)
+
+
+FORMULA_TEMPLATES = FormulaTemplates()
+
+
 class SpellCoefficientPolicy(object):
     @abstractmethod
     def get_coefficient(self, spell, character, cast_time=0, hot_duration=0, empowered=0):
@@ -186,18 +212,34 @@ class HealingSpell(object):
             HealParts.MANA_COST: mana_cost
         }
 
-    @abstractmethod
+    # spell parts of the bonus healing stat used by the heal formula, one bonus healing argument of healing() each
+    BONUS_HEALING_PARTS = ()
+
     def get_healing(self, character):
+        return self.healing(character, *[
+            character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=part)
+            for part in self.BONUS_HEALING_PARTS])
+
+    @abstractmethod
+    def healing(self, character, *bonus_healing):
+        """heal with the given bonus healing values (scalars or arrays, see BONUS_HEALING_PARTS)"""
         pass
 
     @property
-    @abstractmethod
     def formula(self):
+        """excel formula of the heal (direct and tick formulas for hybrid spells)"""
+        return FORMULA_TEMPLATES.get((self.identifier, "formula"), self._formula)
+
+    @abstractmethod
+    def _formula(self):
         pass
 
     @property
-    @abstractmethod
     def coef_formula(self):
+        return FORMULA_TEMPLATES.get((self.identifier, "coef"), self._coef_formula)
+
+    @abstractmethod
+    def _coef_formula(self):
         pass
 
     @property
@@ -278,6 +320,11 @@ class HealingSpell(object):
         return character.spell_effects.apply((self.name, info), self.base_data[info], character, spell=self)
 
     def spell_info_formula(self, info, **context):
+        return FORMULA_TEMPLATES.get((self.identifier, info, FormulaTemplates.context_key(context)),
+                                     self._spell_info_formula, info, **context)
+
+    def _spell_info_formula(self, info, **context):
+        from character import FULL_DRUID
         if info == HealParts.N_TICKS:
             return "QUOTIENT(#{spell}.{duration}#; #{spell}.{period}#)".format(
                 spell=self.identifier, duration=HealParts.DURATION, period=HealParts.TICK_PERIOD)
@@ -295,20 +342,95 @@ class HealingSpell(object):
         return self.identifier
 
 
+class SpellTable(object):
+    """Values of a spell derived for a character (stats, talents, gear and buffs), computed once. Get it with
+    character.spell_table(spell): a character with other buffs (e.g. an on use trinket) has its own tables."""
+    def __init__(self, spell, character):
+        self.spell = spell
+        self.mana_cost = spell.mana_cost(character)
+        self.cast_time = spell.cast_time(character)
+        self.duration = spell.duration(character)
+        self.tick_period = spell.tick_period(character)
+        self.n_ticks = self.duration // self.tick_period if self.tick_period > 0 else 0
+        self.max_stacks = spell.max_stacks(character)
+        self.spell_crit = character.get_stat(Stats.SPELL_CRIT)
+        self.direct, self.tick = SpellTable.split_healing(spell, spell.get_healing(character))
+
+    @staticmethod
+    def split_healing(spell, healing):
+        """(direct heal, hot tick) of a get_healing or healing result, None for the part the spell does not have"""
+        if spell.type == HealingSpell.TYPE_DIRECT:
+            return healing, None
+        elif spell.type == HealingSpell.TYPE_HYBRID:
+            return healing
+        return None, healing
+
+
+class HealMatrices(object):
+    """Heal of the ranks of a spell (rows) over a grid of bonus healing values (columns), see heal_matrices.
+    - total: average heal of one cast (direct heal with crits and all its ticks)
+    - hps: total over the time the heal lands (cast time, at least a GCD, for direct heals, duration otherwise)
+    - hpm: total per mana
+    - hpet: total per execution time, the time the cast keeps the healer busy (cast time, at least a GCD, channel
+      duration for channeled spells)"""
+    def __init__(self, spells, bonus_healing, total, mana_cost, heal_time, execution_time):
+        self.spells = spells
+        self.bonus_healing = bonus_healing
+        self.total = total
+        self.hps = total / heal_time
+        self.hpm = total / mana_cost
+        self.hpet = total / execution_time
+
+
+def heal_matrices(spells, character, bonus_healing):
+    """evaluate all the ranks of a spell over a grid of bonus healing values of the character (before the spell
+    specific bonus healing modifiers) in one call. The heal formula and coefficient of each rank are evaluated once
+    for the whole grid, with the same code as get_healing"""
+    if len(spells) == 0 or len({spell.name for spell in spells}) > 1:
+        raise ValueError("heal_matrices expects ranks of a single spell, got {}".format(spells))
+    bonus_healing = np.atleast_1d(np.asarray(bonus_healing, dtype=float))
+    spell_crit = character.get_stat(Stats.SPELL_CRIT)
+    gcd = character.get_stat(Stats.GCD)
+    tables = [character.spell_table(spell) for spell in spells]
+
+    totals = list()
+    for spell, table in zip(spells, tables):
+        bh = [character.stats_effects.apply(Stats.BONUS_HEALING, bonus_healing, character, spell_name=spell.cname,
+                                            spell_part=part)
+              for part in spell.BONUS_HEALING_PARTS]
+        direct, tick = SpellTable.split_healing(spell, spell.healing(character, *bh))
+        total = np.zeros(len(bonus_healing))
+        if direct is not None:
+            total += apply_crit(direct, spell_crit)
+        if tick is not None:
+            total += tick * table.n_ticks
+        totals.append(total)
+
+    def column(values):
+        return np.array(values, dtype=float)[:, None]
+
+    mana_cost = column([table.mana_cost for table in tables])
+    busy = column([max(gcd, table.duration if spell.type == HealingSpell.TYPE_CHANNELED else table.cast_time)
+                   for spell, table in zip(spells, tables)])
+    landing = column([max(gcd, table.cast_time) if spell.type == HealingSpell.TYPE_DIRECT else table.duration
+                      for spell, table in zip(spells, tables)])
+    return HealMatrices(list(spells), bonus_healing, np.vstack(totals), mana_cost, landing, busy)
+
+
 class HealingTouch(HealingSpell):
+    BONUS_HEALING_PARTS = (HealParts.DIRECT,)
+
     def __init__(self, coef_policy, rank, mana_cost, lvl, avg_heal, cast_time):
         super().__init__(coef_policy, "healing_touch", HealingSpell.TYPE_DIRECT, rank, mana_cost, lvl, cast_time=cast_time)
         self.avg_heal = avg_heal
 
-    def get_healing(self, character):
-        bh = character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=HealParts.DIRECT)
+    def healing(self, character, bh):
         coef = self._get_spell_coefficient(character, self.coef_policy)
         gift = 1 + character.talents.get(DruidTalents.GIFT_OF_NATURE) * 0.02
         direct_heal = (self.avg_heal + coef * bh) * gift
         return character.gear.apply_spell_effect(self.name, HealParts.FINAL_DIRECT, direct_heal, character)
 
-    @property
-    def formula(self):
+    def _formula(self):
         from character import FULL_DRUID
         gift_formula = "(1 + #Talents.{}# * 0.02)".format(DruidTalents.GIFT_OF_NATURE[0])
         stat_formula = "#Stats.{}#".format(Stats.BONUS_HEALING)
@@ -320,8 +442,7 @@ class HealingTouch(HealingSpell):
         )
         return FULL_DRUID.gear.spell_effects.formula((self.name, HealParts.FINAL_DIRECT), formula)
 
-    @property
-    def coef_formula(self):
+    def _coef_formula(self):
         return self.coef_policy.formula \
             .replace("#Talents.empowered#", "0.1 * #Talents.{}#".format(DruidTalents.EMPOWERED_TOUCH[0])) \
             .replace("Spell.", self.identifier + ".")
@@ -330,8 +451,8 @@ class HealingTouch(HealingSpell):
         return coef_policy.get_coefficient(self, character, self.cast_time(character),
                                            empowered=character.talents.get(DruidTalents.EMPOWERED_TOUCH) * 0.1)
 
-    def spell_info_formula(self, info, **context):
-        formula = super().spell_info_formula(info, **context)
+    def _spell_info_formula(self, info, **context):
+        formula = super()._spell_info_formula(info, **context)
         if info == HealParts.CAST_TIME:
             base = "#{spell}.base_{time}#".format(spell=self.identifier, time=HealParts.CAST_TIME)
             formula = formula.replace(
@@ -346,6 +467,8 @@ class HealingTouch(HealingSpell):
 
 
 class Rejuvenation(HealingSpell):
+    BONUS_HEALING_PARTS = (HealParts.TICK,)
+
     def __init__(self, coef_policy, rank, mana_cost, lvl, hot_heal, duration, tick_period=3):
         super().__init__(coef_policy, "rejuvenation", HealingSpell.TYPE_HOT, rank, mana_cost, lvl, tick_period=tick_period, duration=duration)
         self.hot_heal = hot_heal
@@ -354,15 +477,13 @@ class Rejuvenation(HealingSpell):
     def hot_heal_tick(self):
         return self.hot_heal / self.base_n_ticks
 
-    def get_healing(self, character):
-        bh = character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=HealParts.TICK)
+    def healing(self, character, bh):
         coef = self._get_spell_coefficient(character, self.coef_policy)
         improved = 1 + character.talents.get(DruidTalents.GIFT_OF_NATURE) * 0.02 + character.talents.get(DruidTalents.IMPROVED_REJUVENATION) * 0.05
         hot_heal = (self.hot_heal_tick + bh * coef / self.base_n_ticks) * improved
         return character.gear.apply_spell_effect(self.name, HealParts.FINAL_TICK, hot_heal, character)
 
-    @property
-    def formula(self):
+    def _formula(self):
         from character import FULL_DRUID
         gift_improved_formula = "(1 + #Talents.{}# * 0.02 + #Talents.{}# * 0.05)".format(
             DruidTalents.GIFT_OF_NATURE[0], DruidTalents.IMPROVED_REJUVENATION[0])
@@ -375,8 +496,7 @@ class Rejuvenation(HealingSpell):
             ticks=self.base_n_ticks)
         return FULL_DRUID.gear.spell_effects.formula((self.name, HealParts.FINAL_TICK), formula)
 
-    @property
-    def coef_formula(self):
+    def _coef_formula(self):
         return self.coef_policy.formula \
             .replace("#Talents.empowered#", "0.04 * #Talents.{}#".format(DruidTalents.EMPOWERED_REJUVENATION[0])) \
             .replace("Spell.", self.identifier + ".")
@@ -387,6 +507,8 @@ class Rejuvenation(HealingSpell):
 
 
 class Regrowth(HealingSpell):
+    BONUS_HEALING_PARTS = (HealingSpell.TYPE_DIRECT, HealingSpell.TYPE_HOT)
+
     def __init__(self, coef_policy, rank, mana_cost, lvl, avg_direct_heal, hot_heal, cast_time, tick_period, duration):
         super().__init__(coef_policy, "regrowth", HealingSpell.TYPE_HYBRID, rank, mana_cost, lvl,
                          cast_time=cast_time, duration=duration, tick_period=tick_period, max_stacks=1)
@@ -397,9 +519,7 @@ class Regrowth(HealingSpell):
     def hot_heal_tick(self):
         return self.hot_heal / self.base_n_ticks
 
-    def get_healing(self, character):
-        bh_direct = character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=HealingSpell.TYPE_DIRECT)
-        bh_hot = character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=HealingSpell.TYPE_HOT)
+    def healing(self, character, bh_direct, bh_hot):
         coef_direct, coef_hot = self._get_spell_coefficient(character, self.coef_policy)
         gift = 1 + character.talents.get(DruidTalents.GIFT_OF_NATURE) * 0.02
         direct_heal = (self.avg_direct_heal + coef_direct * bh_direct) * gift
@@ -407,8 +527,7 @@ class Regrowth(HealingSpell):
         return character.gear.apply_spell_effect(self.name, HealParts.FINAL_DIRECT, direct_heal, character), \
             character.gear.apply_spell_effect(self.name, HealParts.FINAL_TICK, hot_heal, character)
 
-    @property
-    def formula(self):
+    def _formula(self):
         from character import FULL_DRUID
         gift_formula = "(1 + #Talents.{}# * 0.02)".format(DruidTalents.GIFT_OF_NATURE[0])
         stat_formula = "#Stats.{}#".format(Stats.BONUS_HEALING)
@@ -430,8 +549,7 @@ class Regrowth(HealingSpell):
         return FULL_DRUID.gear.spell_effects.formula((self.name, HealParts.FINAL_DIRECT), direct_formula), \
             FULL_DRUID.gear.spell_effects.formula((self.name, HealParts.FINAL_TICK), hot_formula)
 
-    @property
-    def coef_formula(self):
+    def _coef_formula(self):
         coef_direct_formula, coef_hot_formula = self.coef_policy.formula
         return coef_direct_formula.replace("#Talents.empowered#", "0.04 * #Talents.{}#".format(DruidTalents.EMPOWERED_REJUVENATION[0])).replace("Spell.", self.identifier + "."), \
                coef_hot_formula.replace("#Talents.empowered#", "0.04 * #Talents.{}#".format(DruidTalents.EMPOWERED_REJUVENATION[0])).replace("Spell.", self.identifier + ".")
@@ -442,6 +560,8 @@ class Regrowth(HealingSpell):
 
 
 class Lifebloom(HealingSpell):
+    BONUS_HEALING_PARTS = (HealParts.DIRECT, HealParts.TICK)
+
     def __init__(self, coef_policy, rank, mana_cost, lvl, direct_heal, hot_heal, tick_period, duration):
         super().__init__(coef_policy, "lifebloom", HealingSpell.TYPE_HYBRID, rank, mana_cost, lvl,
                          duration=duration, tick_period=tick_period, max_stacks=3, direct_first=False)
@@ -452,9 +572,7 @@ class Lifebloom(HealingSpell):
     def hot_heal_tick(self):
         return self.hot_heal / self.base_n_ticks
 
-    def get_healing(self, character):
-        bh_direct = character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=HealParts.DIRECT)
-        bh_hot = character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=HealParts.TICK)
+    def healing(self, character, bh_direct, bh_hot):
         coef_direct, coef_hot = self._get_spell_coefficient(character, self.coef_policy)
         gift = 1 + character.talents.get(DruidTalents.GIFT_OF_NATURE) * 0.02
         direct_heal = (self.direct_heal + coef_direct * bh_direct) * gift
@@ -466,8 +584,7 @@ class Lifebloom(HealingSpell):
         return coef_policy.get_coefficient(self, character, self.cast_time, self.base_duration,
                                            empowered=character.talents.get(DruidTalents.EMPOWERED_REJUVENATION) * 0.04)
 
-    @property
-    def formula(self):
+    def _formula(self):
         from character import FULL_DRUID
         gift_formula = "(1 + #Talents.{}# * 0.02)".format(DruidTalents.GIFT_OF_NATURE[0])
         stat_formula = "#Stats.{}#".format(Stats.BONUS_HEALING)
@@ -487,8 +604,7 @@ class Lifebloom(HealingSpell):
         return FULL_DRUID.gear.spell_effects.formula((self.name, HealParts.FINAL_DIRECT), direct_formula), \
             FULL_DRUID.gear.spell_effects.formula((self.name, HealParts.FINAL_TICK), hot_formula)
 
-    @property
-    def coef_formula(self):
+    def _coef_formula(self):
         coef_direct_formula, coef_hot_formula = self.coef_policy.formula
         return coef_direct_formula.replace("#Talents.empowered#",
                                            "0.04 * #Talents.{}#".format(DruidTalents.EMPOWERED_REJUVENATION[0])).replace("Spell.", self.identifier + "."), \
@@ -497,6 +613,8 @@ class Lifebloom(HealingSpell):
 
 
 class Tranquility(HealingSpell):
+    BONUS_HEALING_PARTS = (HealParts.TICK,)
+
     def __init__(self, coef_policy, rank, mana_cost, lvl, hot_heal, duration, tick_period):
         super().__init__(coef_policy, "tranquility", HealingSpell.TYPE_CHANNELED, rank, mana_cost, lvl,
                          duration=duration, tick_period=tick_period)
@@ -506,15 +624,13 @@ class Tranquility(HealingSpell):
     def hot_heal_tick(self):
         return self.hot_heal / self.base_n_ticks
 
-    def get_healing(self, character):
-        bh = character.get_stat(Stats.BONUS_HEALING, spell_name=self.cname, spell_part=HealParts.TICK)
+    def healing(self, character, bh):
         coef = self._get_spell_coefficient(character, self.coef_policy)
         improved = 1 + character.talents.get(DruidTalents.GIFT_OF_NATURE) * 0.02
         hot_heal = (self.hot_heal_tick + bh * coef / self.base_n_ticks) * improved
         return character.gear.apply_spell_effect(self.name, HealParts.FINAL_TICK, hot_heal, character)
 
-    @property
-    def formula(self):
+    def _formula(self):
         from character import FULL_DRUID
         gift_improved_formula = "(1 + #Talents.{}# * 0.02)".format(DruidTalents.GIFT_OF_NATURE[0])
         stat_formula = "#Stats.{}#".format(Stats.BONUS_HEALING)
@@ -527,8 +643,7 @@ class Tranquility(HealingSpell):
         )
         return FULL_DRUID.spell_effects.formula((self.name, HealParts.FINAL_TICK), formula)
 
-    @property
-    def coef_formula(self):
+    def _coef_formula(self):
         return self.coef_policy.formula \
             .replace("#Talents.empowered#", "0.04 * #Talents.{}#".format(DruidTalents.EMPOWERED_REJUVENATION[0])) \
             .replace("Spell.", self.identifier + ".")
@@ -3,12 +3,22 @@ from operator import add, mul
 
 
 class SpellModifierContext(object):
+    INDEXED_KEYS = ("spell_name", "spell_part")
+
     def __init__(self, **context):
         self._context = context
 
     def match_context(self, **current_context):
         return all([current_context.get(k) == v for k, v in self._context.items()])
 
+    def get(self, key):
+        return self._context.get(key)
+
+    @property
+    def indexable(self):
+        """whether matching only depends on the indexed keys"""
+        return all([k in SpellModifierContext.INDEXED_KEYS for k in self._context])
+
 
 class StatsModifier(object):
     TYPE_ADDITIVE = "ADDITIVE"
@@ -22,12 +32,13 @@ class StatsModifier(object):
         self._type = _type
         self._cond_cm_group = cond_cm_group
         self._context = SpellModifierContext(**context)
+        self._aggr_fn = add if self._type == StatsModifier.TYPE_ADDITIVE else mul
 
     def __repr__(self):
         return "{}({})".format(self._name, ",".join(map(str, self._stats)))
 
     def _aggr(self):
-        return add if self._type == StatsModifier.TYPE_ADDITIVE else mul
+        return self._aggr_fn
 
     def _str_aggr(self):
         return "+" if self._type == StatsModifier.TYPE_ADDITIVE else "*"
@@ -38,9 +49,13 @@ class StatsModifier(object):
         return "IF(#{}.{}#; {}; {})".format(self._cond_cm_group, self.name, formula, 0 if self._type == StatsModifier.TYPE_ADDITIVE else 1)
 
     def apply(self, stat, base_value, character, **context):
-        if not self._context.match_context(**context) or stat not in set(self._stats):
+        if stat not in self._functions or not self._context.match_context(**context):
             return base_value
-        return self._aggr()(base_value, self._functions[stat](character, **context))
+        return self._aggr_fn(base_value, self._functions[stat](character, **context))
+
+    def apply_matched(self, stat, base_value, character, **context):
+        """apply without checking the stat and context, caller must have checked that the modifier applies"""
+        return self._aggr_fn(base_value, self._functions[stat](character, **context))
 
     def formula(self, stat, base_formula, **context):
         if not self._context.match_context(**context) or stat not in set(self._stats):
@@ -51,6 +66,10 @@ class StatsModifier(object):
     def affected_stats(self):
         return self._stats
 
+    @property
+    def context(self):
+        return self._context
+
     @property
     def name(self):
         return self._name
@@ -95,6 +114,26 @@ class StatsModifierArray(object):
                 elif buff.type == StatsModifier.TYPE_MULTIPLICATIVE:
                     self._multiplicative[stat].append(buff)
 
+        # (stat, spell_name, spell_part) -> apply functions of the modifiers that can apply in this context,
+        # filled on first use of a given key
+        self._dispatch = dict()
+        # (stat, stat formula, context) -> rendered formula, the modifiers of an array never change
+        self._formulas = dict()
+
+    def _dispatch_modifiers(self, stat, spell_name, spell_part):
+        key = (stat, spell_name, spell_part)
+        if key in self._dispatch:
+            return self._dispatch[key]
+        indexed = {k: v for k, v in zip(SpellModifierContext.INDEXED_KEYS, (spell_name, spell_part)) if v is not None}
+        dispatch = list()
+        for modifier in self._additive.get(stat, []) + self._multiplicative.get(stat, []):
+            if not modifier.context.indexable:
+                dispatch.append(modifier.apply)  # full context check at application
+            elif modifier.context.match_context(**indexed):
+                dispatch.append(modifier.apply_matched)
+        self._dispatch[key] = dispatch
+        return dispatch
+
     @property
     def name(self):
         return self._name
@@ -108,20 +147,22 @@ class StatsModifierArray(object):
 
     def apply(self, stat, base_value, character, **context):
         stat_value = base_value
-        for buff in self._additive[stat]:
-            stat_value = buff.apply(stat, stat_value, character, **context)
-        for buff in self._multiplicative[stat]:
-            stat_value = buff.apply(stat, stat_value, character, **context)
+        for apply in self._dispatch_modifiers(stat, context.get("spell_name"), context.get("spell_part")):
+            stat_value = apply(stat, stat_value, character, **context)
         return stat_value
 
     def formula(self, stat, stat_formula, **context):
+        key = (stat, stat_formula, tuple(sorted(context.items())))
+        if key in self._formulas:
+            return self._formulas[key]
         formula = stat_formula
-        for buff in self._additive[stat]:
+        for buff in self._additive.get(stat, []):
             formula = buff.formula(stat, formula, **context)
         formula = "({})".format(formula)
-        for buff in self._multiplicative[stat]:
+        for buff in self._multiplicative.get(stat, []):
             formula = buff.formula(stat, formula, **context)
-        return "({})".format(formula)
+        self._formulas[key] = "({})".format(formula)
+        return self._formulas[key]
 
     def has_modifier(self, name):
         return name in {b.name for b in self._buffs}
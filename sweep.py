@@ -0,0 +1,135 @@
+import itertools
+import os
+import time
+from collections import defaultdict
+from fnmatch import fnmatchcase
+
+# relative cost of simulating a filler (spawns several filler targets) and an on use item, per assignment
+FILLER_COST = 3
+ON_USE_COST = 0.25
+# duration used to estimate simulations running until OOM (negative fight duration)
+OOM_DURATION = 600
+
+# configuration axes combined by a sweep, in combination order
+AXES = ["characters", "buffs", "talents", "rotations", "gems_policy"]
+
+
+def entry_name(axis, entry):
+    """name used to match an axis entry in filters (gems policies have no name, their values are joined)"""
+    if axis == "gems_policy":
+        return "_".join(map(str, entry.values()))
+    return entry["name"]
+
+
+class CombinationFilter(object):
+    """Filter of the combinations of a configuration, described in its optional "filters" field:
+    - "include": list of rules, if any, a combination must match one of them
+    - "exclude": list of rules, a combination matching any of them is dropped
+    - "pairs": list of {"axes": [axis, ...], "on": field}, entries of these axes are only combined if their `field`
+      values are equal (an entry without the field is combined with any entry)
+    A rule maps axes to lists of name patterns (fnmatch syntax), it matches a combination if the name of the entry of
+    each listed axis matches one of its patterns."""
+    def __init__(self, include=None, exclude=None, pairs=None):
+        self._include = [self._check_rule(r) for r in include] if include is not None else None
+        self._exclude = [self._check_rule(r) for r in exclude] if exclude is not None else list()
+        self._pairs = list()
+        for pair in pairs if pairs is not None else list():
+            if "on" not in pair or len(pair.get("axes", [])) < 2:
+                raise ValueError("pairing rule needs an 'on' field and at least two 'axes': {}".format(pair))
+            self._pairs.append(([AXES.index(self._check_axis(axis)) for axis in pair["axes"]], pair["on"]))
+
+    @staticmethod
+    def _check_axis(axis):
+        if axis not in AXES:
+            raise ValueError("unknown axis '{}', expected one of {}".format(axis, ", ".join(AXES)))
+        return axis
+
+    @classmethod
+    def _check_rule(cls, rule):
+        return [(AXES.index(cls._check_axis(axis)), [patterns] if isinstance(patterns, str) else patterns)
+                for axis, patterns in rule.items()]
+
+    @staticmethod
+    def from_dict(data):
+        return CombinationFilter(include=data.get("include"), exclude=data.get("exclude"), pairs=data.get("pairs"))
+
+    @staticmethod
+    def _matches(rule, names):
+        return all(any(fnmatchcase(names[axis], p) for p in patterns) for axis, patterns in rule)
+
+    def accept(self, entries, names):
+        """entries and names of a combination, one per axis"""
+        for axes, field in self._pairs:
+            values = {entries[axis][field] for axis in axes if field in entries[axis]}
+            if len(values) > 1:
+                return False
+        if self._include is not None and not any(self._matches(rule, names) for rule in self._include):
+            return False
+        return not any(self._matches(rule, names) for rule in self._exclude)
+
+
+def expand_combinations(config):
+    """lazily generate the index tuples (one index per axis, see AXES) of the combinations of a configuration that
+    pass its filters"""
+    combination_filter = CombinationFilter.from_dict(config.get("filters", {}))
+    entries = [config[axis] for axis in AXES]
+    names = [[entry_name(axis, entry) for entry in axis_entries] for axis, axis_entries in zip(AXES, entries)]
+    for cell in itertools.product(*[range(len(axis_entries)) for axis_entries in entries]):
+        if combination_filter.accept([entries[k][i] for k, i in enumerate(cell)],
+                                     [names[k][i] for k, i in enumerate(cell)]):
+            yield cell
+
+
+def estimate_cost(assignments, n_on_use, fight_duration):
+    """rough simulation cost of a combination: grows with the simulated duration, the number of timelines and the
+    number of on use items evaluated at each heal"""
+    duration = fight_duration if fight_duration >= 0 else OOM_DURATION
+    n_timelines = len(assignments) + (FILLER_COST if assignments.has_filler else 0)
+    return duration * n_timelines * (1 + ON_USE_COST * n_on_use)
+
+
+def make_batches(tasks, costs, n_workers, chunks_per_worker=4):
+    """group tasks in batches ordered longest first. Batches are filled up to a target cost such that each worker
+    gets about chunks_per_worker of them: expensive tasks run alone and cheap ones are chunked together"""
+    if len(tasks) == 0:
+        return []
+    if n_workers < 1 or chunks_per_worker < 1:
+        raise ValueError("n_workers and chunks_per_worker must be positive")
+    target = sum(costs) / (n_workers * chunks_per_worker)
+    batches, batch, batch_cost = list(), list(), 0
+    for cost, task in sorted(zip(costs, tasks), key=lambda v: -v[0]):
+        batch.append(task)
+        batch_cost += cost
+        if batch_cost >= target:
+            batches.append(batch)
+            batch, batch_cost = list(), 0
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def run_batch(fn, batch):
+    """run fn(*args) for each (key, args) of the batch, returns (worker pid, busy seconds, [(key, result)])"""
+    start = time.perf_counter()
+    results = [(key, fn(*args)) for key, args in batch]
+    return os.getpid(), time.perf_counter() - start, results
+
+
+class Utilization(object):
+    """busy time and number of tasks per worker over a parallel run"""
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._busy = defaultdict(float)
+        self._n_tasks = defaultdict(int)
+
+    def add(self, worker, busy, n_tasks):
+        self._busy[worker] += busy
+        self._n_tasks[worker] += n_tasks
+
+    def report(self):
+        wall = time.perf_counter() - self._start
+        lines = ["worker utilization over {:.1f}s:".format(wall)]
+        for worker in sorted(self._busy):
+            lines.append("  {}: {} combinations, busy {:.1f}s ({:.0%})".format(
+                worker, self._n_tasks[worker], self._busy[worker], self._busy[worker] / wall if wall > 0 else 0))
+        return "\n".join(lines)
@@ -1,5 +1,8 @@
+import math
 import operator
 
+import numpy as np
+
 
 def bisect_right(a, x, lo=0, hi=None, *, key=None):
     """Return the index where to insert item x in list a, assuming a is sorted.
@@ -45,6 +48,21 @@ def sort_by(t, *arrays, f=None):
     return tuple(zip(*all_sorted))
 
 
+def sqrt(value):
+    """square root of a scalar or, elementwise, of an array"""
+    return np.sqrt(value) if isinstance(value, np.ndarray) else math.sqrt(value)
+
+
+def maximum(a, b):
+    """max of two scalars or, elementwise, of arrays"""
+    return np.maximum(a, b) if isinstance(a, np.ndarray) or isinstance(b, np.ndarray) else max(a, b)
+
+
+def minimum(a, b):
+    """min of two scalars or, elementwise, of arrays"""
+    return np.minimum(a, b) if isinstance(a, np.ndarray) or isinstance(b, np.ndarray) else min(a, b)
+
+
 def apply_crit(value, crit_proba):
     return (1 + crit_proba * 0.5) * value
 
@@ -0,0 +1,176 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def worker_name():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """Sweep tasks stored in a SQLite file, shared by worker processes of any host that can access the file (SQLite
+    locking must work on the shared filesystem). A worker claims a task by taking a lease on it and renews it while the
+    task runs (see LeaseHeartbeat); tasks whose lease expired (crashed or killed worker) are claimed again, up to
+    max_attempts times."""
+    def __init__(self, path, timeout=60):
+        self._path = path
+        self._connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)""")
+        self._connection.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            cost REAL NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            owner TEXT,
+            lease_until REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            record TEXT,
+            artifact TEXT,
+            error TEXT
+        )""")
+
+    @property
+    def path(self):
+        return self._path
+
+    def close(self):
+        self._connection.close()
+
+    def _transaction(self):
+        """write transaction taking the database lock immediately, so that concurrent claims are serialized"""
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def fill(self, meta, tasks, max_attempts=3, lease=600):
+        """create the queue: meta is a json-serializable dict shared with workers, tasks are (id, payload, cost)"""
+        self._transaction()
+        try:
+            if self._connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] > 0:
+                raise ValueError("work queue '{}' is not empty".format(self._path))
+            self._connection.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", [
+                ("meta", json.dumps(meta)), ("max_attempts", json.dumps(max_attempts)), ("lease", json.dumps(lease))])
+            self._connection.executemany("INSERT INTO tasks (id, payload, cost, status) VALUES (?, ?, ?, ?)",
+                                         [(i, json.dumps(payload), cost, STATUS_PENDING) for i, payload, cost in tasks])
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _meta(self, key):
+        row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise ValueError("work queue '{}' was not filled".format(self._path))
+        return json.loads(row[0])
+
+    @property
+    def meta(self):
+        return self._meta("meta")
+
+    @property
+    def lease(self):
+        return self._meta("lease")
+
+    def claim(self, owner):
+        """lease the most expensive claimable task, returns (id, payload) or None"""
+        now = time.time()
+        self._transaction()
+        try:
+            row = self._connection.execute(
+                "SELECT id, payload FROM tasks WHERE (status = ? OR (status = ? AND lease_until < ?)) AND attempts < ? "
+                "ORDER BY cost DESC, id LIMIT 1",
+                (STATUS_PENDING, STATUS_RUNNING, now, self._meta("max_attempts"))).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    "UPDATE tasks SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    (STATUS_RUNNING, owner, now + self._meta("lease"), row[0]))
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def renew(self, task_id, owner):
+        """extend the lease of a claimed task, returns False if the lease was lost to another worker"""
+        cursor = self._connection.execute(
+            "UPDATE tasks SET lease_until = ? WHERE id = ? AND owner = ? AND status = ?",
+            (time.time() + self.lease, task_id, owner, STATUS_RUNNING))
+        return cursor.rowcount == 1
+
+    def complete(self, task_id, owner, record, artifact=None):
+        """store the result of a claimed task, record and artifact (optional) are json-serializable. Returns False if the
+        lease was lost to another worker"""
+        cursor = self._connection.execute(
+            "UPDATE tasks SET status = ?, record = ?, artifact = ?, error = NULL WHERE id = ? AND owner = ? AND status = ?",
+            (STATUS_DONE, json.dumps(record), None if artifact is None else json.dumps(artifact), task_id, owner,
+             STATUS_RUNNING))
+        return cursor.rowcount == 1
+
+    def fail(self, task_id, owner, error):
+        """release a claimed task after an error, it is retried until it reaches max_attempts"""
+        self._connection.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ?, owner = NULL, "
+            "lease_until = NULL WHERE id = ? AND owner = ? AND status = ?",
+            (self._meta("max_attempts"), STATUS_PENDING, STATUS_FAILED, error, task_id, owner, STATUS_RUNNING))
+
+    def counts(self):
+        """number of tasks per status, tasks with an expired lease and no attempt left are counted as failed"""
+        counts = {status: 0 for status in [STATUS_PENDING, STATUS_RUNNING, STATUS_DONE, STATUS_FAILED]}
+        rows = self._connection.execute(
+            "SELECT CASE WHEN status = ? AND lease_until < ? AND attempts >= ? THEN ? ELSE status END, COUNT(*) "
+            "FROM tasks GROUP BY 1", (STATUS_RUNNING, time.time(), self._meta("max_attempts"), STATUS_FAILED))
+        counts.update(dict(rows.fetchall()))
+        return counts
+
+    def errors(self):
+        return self._connection.execute(
+            "SELECT id, error FROM tasks WHERE error IS NOT NULL AND status != ? ORDER BY id", (STATUS_DONE,)).fetchall()
+
+    def results(self):
+        """(id, record, artifact) of the completed tasks, by task id"""
+        rows = self._connection.execute(
+            "SELECT id, record, artifact FROM tasks WHERE status = ? ORDER BY id", (STATUS_DONE,))
+        for task_id, record, artifact in rows:
+            yield task_id, json.loads(record), None if artifact is None else json.loads(artifact)
+
+
+class LeaseHeartbeat(object):
+    """context manager renewing the lease of a claimed task every `period` seconds (default: a third of the lease)
+    while the task runs. Renewals are made from a background thread with its own connection, so that they go on during
+    long simulations; they stop once the lease is lost"""
+    def __init__(self, path, task_id, owner, period=None):
+        self._path = path
+        self._task_id = task_id
+        self._owner = owner
+        self._period = period
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        queue = WorkQueue(self._path)
+        try:
+            period = queue.lease / 3 if self._period is None else self._period
+            while not self._stop.wait(period):
+                try:
+                    if not queue.renew(self._task_id, self._owner):
+                        break
+                except sqlite3.OperationalError:
+                    continue  # database busy, retried at the next beat
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        return False